@@ -11,12 +11,17 @@ Patch
 
 Patch is the core class of the empirical module. It reads and validates
 metadata and data table files, and patch objects are the first argument to all
-of the empirical metric functions in this module.
+of the empirical metric functions in this module. MappedPatch reads its data
+table in chunks from memory mapped files, for censuses too large for memory.
+PatchView is a Patch holding a selection of the records of another Patch, as
+made for each split by the metric functions.
 
 .. autosummary::
    :toctree: generated/
 
    Patch
+   MappedPatch
+   PatchView
 
 Metrics
 =======
@@ -43,6 +48,6 @@ Other
 
 """
 
-from ._empirical import (Patch,
+from ._empirical import (Patch, MappedPatch, PatchView,
                          sad, ssad, sar, comm_grid, o_ring,
                          empirical_cdf)
@@ -2,18 +2,32 @@ from __future__ import division
 import os
 import re
 import copy
+import operator
+import json
+import shutil
+import hashlib
+import tempfile
 from configparser import ConfigParser
 import itertools
 from copy import deepcopy
 import logging
+import multiprocessing
+import sqlite3
+import atexit
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sparse
 import scipy.spatial.distance as dist
+from scipy.spatial import cKDTree
 try:
     import shapely.geometry as geo
 except:
     pass
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 # TODO: Make shapely import work with pyinstaller
 
 from ..misc import doc_sub, log_start_end
@@ -34,6 +48,12 @@ metric_return = \
         tuple is a string indicating the split values used for that result and
         second element is a dataframe giving the result."""
 
+n_jobs_param = \
+    """n_jobs : int
+        Number of processes across which to analyze splits, or None to use
+        one process per processor. Results are returned in the same order as
+        for a single process. Default 1."""
+
 cols_note = \
     """The parameter ``cols`` is a string describing which column in the data
     table should be used for which "special columns" in analysis. The five
@@ -105,13 +125,30 @@ class Patch(object):
         Path to metadata file describing census data
     subset : str
         String describing subset of data to use for Patch analysis. See Notes.
+    cache : bool
+        If True, a csv data file is read through a binary cache stored next
+        to it, which is written on the first read. See Notes. Default False.
+    cols : str
+        If given, only the columns named in this string, in the form used by
+        the metric functions, and in splits are kept in table. Default None,
+        keeping all columns.
+    splits : str
+        Splits string, in the form used by the metric functions, whose columns
+        are kept in table when cols is given. Default None.
+    chunk_size : int
+        Number of records of a csv data file read at a time when only some
+        records or columns are kept. See Notes. Default 100000.
+    compact : bool
+        If True, columns of table are stored in the smallest types that hold
+        their values exactly. See Notes. Default False.
 
     Attributes
     ----------
     table : dataframe
         Table of census data recorded in patch
-    meta : ConfigParser obj
-        Dict-like metadata, loaded from metadata_path and processed by subset
+    meta : dict
+        Read only dict of metadata sections, loaded from metadata_path and
+        processed by subset
     subset : str
         Subset string passed as parameter
 
@@ -128,18 +165,54 @@ class Patch(object):
     subset operations. For example, the string "year==2005; x>20; x<40;
     spp=='cabr'" loads a data table containing only records for which the year
     is 2005, x values are between 20 and 40, and species is 'cabr'. Note that
-    for categorical columns, the value of the column must be enclosed in single
-    quotes.
-
-    For sql/db files, subset is a SQL query string that selects the data from
-    the data file.
+    for categorical columns, the value of the column should be enclosed in
+    single quotes. Conditions may also be joined with 'or' and grouped with
+    parentheses, and membership may be tested with 'in', as in "spp in
+    ('cabr', 'crcr') or year==2005".
+
+    For sql/db files, subset may be a string as for csv files, which is
+    translated into a parameterized SQL WHERE clause so that only the
+    matching records are read from the database. The table read is named by
+    the option table in the Description section of the metadata, which may be
+    omitted if the database has only one table. Alternatively, subset may be
+    a SQL query string beginning with SELECT, in which case meta is not
+    processed. A sql file is a script that is run once per process to build
+    an in-memory database, and one connection to each database is reused by
+    all patches in a process, until the process exits.
 
     The meta attribute of this object is processed to reflect the value of
     subset. If columns with a min and a max are included in the subset string,
     the min and max values for that column in meta will be updated to reflect
-    the specified limits.
-
-    An empty Patch object can be created with a metadata_path of None.
+    the specified limits. Metadata is parsed once when the Patch is made, and
+    cannot be changed, though a dict of sections may be assigned to meta to
+    replace it. Each column section also gives its min, max, and step as
+    floats, and subpatches share the sections they do not change.
+
+    An empty Patch object can be created with a metadata_path of None. A
+    Patch can also be created from data already in memory, without a
+    metadata or data file, using Patch.from_dataframe or Patch.from_arrays.
+
+    The cache for a csv data file is a directory with the name of the file
+    followed by .cache, holding one binary file per column. It is used only
+    if the path, size, modification time, and md5 hash of the csv file match
+    those recorded when it was written, and is otherwise rewritten. Loading
+    from the cache saves parsing the csv, and numeric columns are memory
+    mapped from the cache files rather than read into memory. String columns
+    are still decoded into memory. The full table is cached, so that one
+    cache serves all subsets.
+
+    If subset or cols is given, a csv data file without a cache is read
+    chunk_size records at a time, and only the records meeting subset and the
+    columns needed are kept from each chunk, so that the full table is never
+    held in memory. For sql/db files, only the columns needed are selected
+    from the database.
+
+    A compact table stores string columns with many repeated values, such as
+    species, as ordered Categoricals, so that they are compared as integer
+    codes. Columns described in the metadata are stored as float32 if no
+    value changes, and other numeric columns holding only whole numbers, such
+    as counts, are stored in the smallest integer type that holds them. The
+    memory saved is logged.
 
     Examples
     --------
@@ -157,24 +230,240 @@ class Patch(object):
     >>> pat = meco.empirical.Patch('~/Desktop/ANBO.txt',
                                     subset="year==2010; row>2")
 
+    >>> # Or make patch object from a dataframe and metadata dict
+    >>> pat = meco.empirical.Patch.from_dataframe(df,
+                    {'row': {'min': 0, 'max': 15, 'step': 1},
+                     'column': {'min': 0, 'max': 15, 'step': 1}})
+
     """
 
-    def __init__(self, metadata_path, subset=''):
+    def __init__(self, metadata_path, subset='', cache=False, cols=None,
+                 splits=None, chunk_size=100000, compact=False):
 
         if not metadata_path:  # Allow for creation of empty patch
             self.meta = None
             self.subset = ''
             self.table = None
         else:
-            self.meta = ConfigParser()
-            self.meta.read(os.path.expanduser(metadata_path))
+            self.meta = _read_meta(metadata_path)
             self.subset = subset
             self.table = self._load_table(metadata_path,
-                                          self.meta['Description']['datapath'])
+                                          self.meta['Description']['datapath'],
+                                          cache, _needed_cols(cols, splits),
+                                          chunk_size)
+            if compact:
+                meta_cols = [col for col in self.meta.keys()
+                             if col != 'Description']
+                self.table = _compact_table(self.table, meta_cols)
 
         self.incremented = False
 
-    def _load_table(self, metadata_path, data_path):
+    @classmethod
+    def from_dataframe(cls, table, meta=None, subset=''):
+        """
+        Create a Patch from a dataframe, without copying it
+
+        Parameters
+        ----------
+        table : dataframe
+            Table of census data
+        meta : dict
+            Dict of dicts giving the min, max, and step of columns, as in the
+            sections of a metadata file, such as ``{'x': {'min': 0, 'max':
+            100, 'step': 0.1}}``. Values may be numbers or strings. An
+            optional 'Description' dict may give name and cols.
+        subset : str
+            String describing subset of data to use for Patch analysis
+
+        Returns
+        -------
+        Patch
+            Patch whose table is table itself if subset is empty, so that
+            changes to one are seen in the other
+
+        """
+
+        patch = cls(None)
+        patch.meta = _meta_from_dict(meta)
+        patch.subset = subset
+        patch.table = _subset_table(table, subset)
+        patch.meta, _ = _subset_meta(patch.meta, subset)
+        return patch
+
+    @classmethod
+    def from_arrays(cls, arrays, meta=None, subset='', columns=None):
+        """
+        Create a Patch from a dict of column arrays, without copying them
+
+        Parameters
+        ----------
+        arrays : dict
+            One dimensional arrays of equal length, keyed by column name
+        meta : dict
+            Metadata for columns, as for from_dataframe
+        subset : str
+            String describing subset of data to use for Patch analysis
+        columns : list
+            Order of columns in table. Default None, giving sorted names.
+
+        Returns
+        -------
+        Patch
+            Patch whose table columns share memory with arrays if subset is
+            empty and pandas does not consolidate them (see Notes)
+
+        Notes
+        -----
+        Pandas versions that consolidate columns of one dtype into a single
+        block copy the arrays, and the table then does not share memory with
+        them.
+
+        """
+
+        if columns is None:
+            columns = sorted(arrays.keys())
+        return cls.from_dataframe(_frame_from_arrays(arrays, columns), meta,
+                                  subset)
+
+    @property
+    def table(self):
+        return self._table
+
+    @table.setter
+    def table(self, table):
+        # Cached cell matrices describe a particular table, so reset them
+        self._table = table
+        self._cell_cache = {}
+
+    @property
+    def meta(self):
+        return self._meta
+
+    @meta.setter
+    def meta(self, meta):
+        # Plain dicts of sections are parsed as by from_dataframe
+        if meta is not None and not isinstance(meta, _PatchMeta):
+            meta = _meta_from_dict(meta)
+        self._meta = meta
+
+    def iter_chunks(self, cols=None):
+        """
+        Iterate over the table in chunks of records
+
+        Parameters
+        ----------
+        cols : list
+            Names of columns needed from each chunk. Chunks may also contain
+            other columns. Default None, giving all columns.
+
+        Yields
+        ------
+        dataframe
+            Chunk of table. For a Patch, the whole table is a single chunk.
+
+        """
+        yield self.table
+
+    def _table_cols(self, cols):
+        # Table in memory holding at least cols, and possibly other columns
+        return self.table
+
+    def _unique(self, col):
+        # Sorted unique values of a column, as np.unique but hashing first
+        return np.sort(pd.unique(self.table[col]))
+
+    def _levels(self, col):
+        # Unique values of a column in order of appearance, without NaN
+        return pd.factorize(self.table[col])[1]
+
+    def _add_ones_col(self, col):
+        self.table[col] = np.ones(len(self.table))
+
+    def _cell_matrix(self, div, spp_col, count_col, x_col, y_col):
+        """
+        Species by cell abundance and presence matrices for a division
+
+        Parameters
+        ----------
+        div : str or tuple
+            Single division of x_col and y_col, such as '2,4'
+        spp_col, count_col, x_col, y_col : str
+            Names of special columns in table
+
+        Returns
+        -------
+        tuple
+            Sorted array of unique species in table, giving the rows of both
+            matrices, followed by sparse matrices of the total count and of
+            the presence (bool) of each species in each cell. Cells are
+            ordered as in _yield_spatial_table, with y varying fastest.
+
+        Notes
+        -----
+        Each record is assigned to its cell in a single pass over the table,
+        and the result is cached by division and columns until the table is
+        replaced. If a finer division that nests this one (each of its x and y
+        divisions is a multiple of this one's) is already cached, the result
+        is summed from blocks of its cells instead. A species is present in a
+        cell if it has any record there, regardless of count.
+
+        """
+
+        x_div, y_div = _div_split_list(div)
+        key = (x_div, y_div, spp_col, count_col, x_col, y_col)
+        if key in self._cell_cache:
+            return self._cell_cache[key]
+
+        # If a finer grid that nests this one is cached, sum blocks of its
+        # cells instead of assigning records to cells again
+        nested = [k for k in self._cell_cache if k[2:] == key[2:] and
+                  eval(k[0]) % eval(x_div) == 0 and
+                  eval(k[1]) % eval(y_div) == 0]
+        if nested:
+            fine_key = min(nested, key=lambda k: eval(k[0]) * eval(k[1]))
+            self._cell_cache[key] = _coarsen_cell_matrix(
+                self._cell_cache[fine_key], fine_key[:2], key[:2])
+            return self._cell_cache[key]
+
+        x_starts_ends = _col_starts_ends(self, x_col, x_div)
+        y_starts_ends = _col_starts_ends(self, y_col, y_div)
+        n_x = eval(x_div)
+        n_y = eval(y_div)
+
+        spp_list = self._unique(spp_col)
+        shape = (len(spp_list), n_x * n_y)
+
+        # Sum matrices of each chunk of records
+        abund = None
+        n_records = None
+        for chunk in self.iter_chunks([spp_col, count_col, x_col, y_col]):
+            x_idx = _cell_index(chunk[x_col], *x_starts_ends)
+            y_idx = _cell_index(chunk[y_col], *y_starts_ends)
+
+            in_cell = (x_idx >= 0) & (y_idx >= 0)
+            rows = _spp_codes(chunk[spp_col], spp_list)[in_cell]
+            cells = x_idx[in_cell] * n_y + y_idx[in_cell]
+            counts = _wide_counts(chunk[count_col])[in_cell]
+
+            # Duplicate (spp, cell) entries are summed on conversion to csr
+            chunk_abund = sparse.coo_matrix((counts, (rows, cells)),
+                                            shape=shape).tocsr()
+            chunk_n_records = sparse.coo_matrix((np.ones(len(rows)),
+                                                 (rows, cells)),
+                                                shape=shape).tocsr()
+            if abund is None:
+                abund, n_records = chunk_abund, chunk_n_records
+            else:
+                abund = abund + chunk_abund
+                n_records = n_records + chunk_n_records
+
+        pres = n_records.astype(bool)
+
+        self._cell_cache[key] = (spp_list, abund, pres)
+        return self._cell_cache[key]
+
+    def _load_table(self, metadata_path, data_path, cache=False,
+                    usecols=None, chunk_size=100000):
         """
         Load data table, taking subset if needed
 
@@ -184,6 +473,13 @@ class Patch(object):
             Path to metadata file
         data_path : str
             Path to data file, absolute or relative to metadata file
+        cache : bool
+            If True, read a csv data file through a binary cache
+        usecols : list
+            Names of columns to keep, or None to keep all. Names not in the
+            data file are ignored.
+        chunk_size : int
+            Number of records of a csv data file to read at a time
 
         Returns
         -------
@@ -198,21 +494,28 @@ class Patch(object):
         extension = data_path.split('.')[-1]
 
         if extension == 'csv':
-            full_table = pd.read_csv(data_path, index_col=False)
-            table = _subset_table(full_table, self.subset)
+            if cache:
+                table = _subset_table(_read_csv_cached(data_path),
+                                      self.subset)
+                if usecols is not None:
+                    table = table[[col for col in table.columns
+                                   if col in usecols]]
+            else:
+                table = _read_csv_subset(data_path, self.subset, usecols,
+                                         chunk_size)
             self.meta, _ = _subset_meta(self.meta, self.subset)
         elif extension in ['db', 'sql']:
-
-            # TODO: deal with incrementing in DB table
-            table = self._get_db_table(data_path, extension)
+            table = self._get_db_table(data_path, extension, usecols)
+            if not _is_sql_query(self.subset):
+                self.meta, _ = _subset_meta(self.meta, self.subset)
         else:
             raise TypeError('Cannot process file of type %s' % extension)
 
         return table
 
-    def _get_db_table(self, data_path, extension):
+    def _get_db_table(self, data_path, extension, usecols=None):
         """
-        Query a database and return query result as a recarray
+        Query a database and return query result as a dataframe
 
         Parameters
         ----------
@@ -220,56 +523,1032 @@ class Patch(object):
             Path to the database file
         extension : str
             Type of database, either sql or db
+        usecols : list
+            Names of columns to select, or None to select all. Names not in
+            the table are ignored. Not used for SQL query subsets.
 
         Returns
         -------
-        table : recarray
-            The database query as a recarray
+        dataframe
+            Table for analysis
 
         """
-        # TODO: This is probably broken
-        raise NotImplementedError, "SQL and db file formats not yet supported"
 
-        # Load table
-        if extension == 'sql':
-            con = lite.connect(':memory:')
-            con.row_factory = lite.Row
-            cur = con.cursor()
+        con = _db_connection(data_path, extension)
 
-            with open(data_path, 'r') as f:
-                sql = f.read()
-
-            cur.executescript(sql)
+        if _is_sql_query(self.subset):
+            return _fetch_columns(con, self.subset, [])
 
+        table_name = (self.meta['Description'].get('table') or
+                      _db_table_name(con, data_path))
+        if usecols is None:
+            select = '*'
         else:
-            con = lite.connect(data_path)
-            con.row_factory = lite.Row
-            cur = con.cursor()
+            table_cols = [row[1] for row in con.execute(
+                'PRAGMA table_info(%s)' % _sql_name(table_name))]
+            select = ', '.join([_sql_name(col) for col in table_cols
+                                if col in usecols])
+        query = 'SELECT %s FROM %s' % (select, _sql_name(table_name))
+        params = []
+        if self.subset:
+            where, params = _compile_subset(self.subset).to_sql()
+            query += ' WHERE ' + where
+
+        return _fetch_columns(con, query, params)
+
+    def _subset_patch(self, subset, index=None):
+        """
+        PatchView of patch with table and metadata subset by a subset string
+
+        If index is given, it is used as the positions in table of the records
+        of the view instead of finding the records matching subset.
+        """
+
+        if index is None:
+            predicate = _compile_subset(subset)
+            index = np.flatnonzero(predicate(self._table_cols(predicate._cols)))
+
+        meta, incremented = _subset_meta(self.meta, subset, incremented=True)
+        return PatchView(self, index, meta, incremented)
+
+
+class PatchView(Patch):
+    """
+    A Patch whose table is a selection of the records of another Patch
+
+    Parameters
+    ----------
+    parent : Patch obj
+        Patch whose table holds the records of the view
+    index : array or slice
+        Positions in the table of parent of the records of the view, in order
+    meta : dict
+        Metadata of the view. Default None, giving the metadata of parent.
+    incremented : bool
+        If True, the min and max of meta have already been incremented.
+        Default False.
+
+    Attributes
+    ----------
+    table : dataframe
+        Table of the records of the view, made from the table of parent when
+        first accessed
+    meta : dict
+        Read only dict of metadata sections
+    subset : str
+        Subset string of parent
+    parent : Patch obj
+        Patch whose table holds the records of the view
+    index : array or slice
+        Positions of the records of the view in the table of parent
 
-        cur.execute(self.subset)
+    Notes
+    -----
+    A PatchView holds only the positions of its records. Columns are taken
+    from the table of parent as they are needed, so that the metrics sad,
+    ssad, sar, and comm_grid copy only the species, count, and coordinate
+    columns of each split, and o_ring only the columns it uses. The full
+    table is made, and kept, only if the table attribute is accessed.
 
-        # Check that table is not empty
-        db_info = cur.fetchall()
+    Subpatches of splits are PatchViews. A view of a view takes its records
+    from the same parent, so that nested views do not copy records either.
+
+    """
+
+    def __init__(self, parent, index, meta=None, incremented=False):
+
+        self.parent = parent
+        self.index = index
+        self.meta = parent.meta if meta is None else meta
+        self.subset = parent.subset
+        self.incremented = incremented
+
+        self._ones_cols = []
+        self._table = None
+        self._cell_cache = {}
+
+    @property
+    def table(self):
+        if self._table is None:
+            cols = list(self.parent.table.columns) + self._ones_cols
+            self._table = self._take(cols)
+        return self._table
+
+    @table.setter
+    def table(self, table):
+        self._table = table
+        self._cell_cache = {}
+
+    def iter_chunks(self, cols=None):
+        """
+        Iterate over the table in chunks of records
+
+        Parameters
+        ----------
+        cols : list
+            Names of columns needed from each chunk. Chunks may also contain
+            other columns. Default None, giving all columns.
+
+        Yields
+        ------
+        dataframe
+            Records of the view as a single chunk, holding only cols unless
+            table has been made
+
+        """
+        yield self._table_cols(cols)
+
+    def _table_cols(self, cols):
+        if self._table is not None or cols is None:
+            return self.table
+        return self._take(cols)
+
+    def _take(self, cols):
+        """
+        Dataframe of cols for the records of the view, indexed as in parent
+        """
+
+        values = dict((col, self._column(col)) for col in cols)
+        if all(isinstance(x, np.ndarray) for x in values.values()):
+            frame = _frame_from_arrays(values, cols)
+        else:  # Categorical columns of compact tables
+            frame = pd.DataFrame(values, columns=cols)
+        frame.index = self.parent.table.index[self.index]
+        return frame
+
+    def _column(self, col):
+        # Values of a column for the records of the view, without the table
+        if self._table is not None:
+            return self._table[col].values
+        if col in self._ones_cols:
+            return np.ones(len(self.parent.table.index[self.index]))
+        if col not in self.parent.table:  # catch error and redisplay for twiggy
+            raise KeyError("Column '%s' not found" % col)
+        return self.parent.table[col].values[self.index]
+
+    def _unique(self, col):
+        return np.sort(pd.unique(self._column(col)))
+
+    def _levels(self, col):
+        return pd.factorize(self._column(col))[1]
+
+    def _add_ones_col(self, col):
+        if self._table is not None:
+            Patch._add_ones_col(self, col)
+        elif col not in self._ones_cols:
+            self._ones_cols.append(col)
+
+    def _subset_patch(self, subset, index=None):
+        """
+        PatchView of the records of the view meeting a subset string, taking
+        its records from the same parent unless table has been made
+        """
+
+        subpatch = Patch._subset_patch(self, subset, index)
+        if self._table is None:
+            if isinstance(self.index, slice):
+                start, stop, step = self.index.indices(len(self.parent.table))
+                subpatch.index = np.arange(start, stop, step)[subpatch.index]
+            else:
+                subpatch.index = self.index[subpatch.index]
+            subpatch.parent = self.parent
+            subpatch._ones_cols = list(self._ones_cols)
+        return subpatch
+
+
+class MappedPatch(Patch):
+    """
+    A Patch whose table is read in chunks from memory mapped columns
+
+    Parameters
+    ----------
+    metadata_path : str
+        Path to metadata file describing census data
+    subset : str
+        String describing subset of data to use for Patch analysis. See
+        Patch.
+    chunk_size : int
+        Number of records read into memory at a time. Default 1000000.
+
+    Attributes
+    ----------
+    table : dataframe
+        Table of census data recorded in patch, read into memory when
+        accessed
+    meta : dict
+        Read only dict of metadata sections, loaded from metadata_path and
+        processed by subset
+    subset : str
+        Subset string passed as parameter
+    chunk_size : int
+        Number of records read into memory at a time
+
+    Notes
+    -----
+    The csv data file must be described by metadata as for a Patch. On first
+    use, it is read a chunk at a time into the binary cache described in the
+    Notes for Patch, and the columns of the cache are memory mapped.
+
+    Records are read from the cache a chunk at a time, and the subset and any
+    splits are applied to each chunk as it is read. The metrics sad, ssad,
+    sar, and comm_grid work from chunks, so that the memory they use is set by
+    chunk_size and by the size of their results rather than by the size of the
+    table. The metric o_ring reads the records of each subset into memory.
+    Reading the table attribute reads the whole table into memory, and logs a
+    warning. The table attribute cannot be set, and a MappedPatch cannot be
+    made with from_dataframe or from_arrays.
+
+    """
+
+    def __init__(self, metadata_path, subset='', chunk_size=1000000):
+
+        if not metadata_path:
+            raise TypeError('MappedPatch requires a metadata file describing '
+                            'a csv data file')
+
+        self.meta = _read_meta(metadata_path)
+        self.subset = subset
+        self.chunk_size = chunk_size
+        self.incremented = False
+
+        metadata_dir = os.path.dirname(os.path.expanduser(metadata_path))
+        data_path = os.path.normpath(os.path.join(metadata_dir,
+                                     self.meta['Description']['datapath']))
+        if data_path.split('.')[-1] != 'csv':
+            raise TypeError('MappedPatch requires a csv data file, not %s' %
+                            data_path)
+
+        cache_dir, key, manifest = _csv_cache(data_path)
+        if not manifest:
+            manifest = _write_cached_csv(data_path, cache_dir, key,
+                                         chunk_size)
+        self._cols, self._arrays, self._col_levels = \
+            _load_cached_columns(cache_dir, manifest)
+        self._n_rows = len(self._arrays[0])
+
+        self._ones_cols = []
+        self._filters = [subset] if subset else []
+        self._cell_cache = {}
+        self.meta, _ = _subset_meta(self.meta, subset)
+
+    @property
+    def table(self):
+        logging.warning('Reading all %d records of MappedPatch table into '
+                        'memory' % self._n_rows)
+        return pd.concat(list(self.iter_chunks()))
+
+    @table.setter
+    def table(self, table):
+        raise TypeError('MappedPatch table is read from its csv cache and '
+                        'cannot be set. Use Patch.from_dataframe for a table '
+                        'in memory.')
+
+    def iter_chunks(self, cols=None):
+        """
+        Iterate over the table in chunks of records
+
+        Parameters
+        ----------
+        cols : list
+            Names of columns needed from each chunk. Chunks may also contain
+            other columns. Default None, giving all columns.
+
+        Yields
+        ------
+        dataframe
+            Records meeting subset among the next chunk_size records of the
+            table. At least one chunk, possibly empty, is always yielded.
+
+        """
+
+        if cols is None:
+            cols = self._cols + self._ones_cols
+
+        # Also read columns needed to subset each chunk
+        read_cols = set(cols)
+        for subset in self._filters:
+            read_cols.update(_compile_subset(subset)._cols)
+
+        for start in range(0, max(self._n_rows, 1), self.chunk_size):
+            stop = min(start + self.chunk_size, self._n_rows)
+            chunk = self._read_rows(read_cols, start, stop)
+            for subset in self._filters:
+                chunk = chunk[_compile_subset(subset)(chunk)]
+            yield chunk
+
+    def _read_rows(self, cols, start, stop):
+        """
+        Dataframe of cols for records start to stop, indexed by record number
+        """
+
+        data = {}
+        for col in cols:
+            if col in self._ones_cols:
+                data[col] = np.ones(stop - start)
+            elif col in self._cols:
+                i = self._cols.index(col)
+                values = np.array(self._arrays[i][start:stop])
+                if self._col_levels[i] is not None:
+                    values = _decode_codes(values, self._col_levels[i])
+                data[col] = values
+            else:  # catch error and redisplay for twiggy
+                raise KeyError("Column '%s' not found" % col)
+
+        col_order = [col for col in self._cols + self._ones_cols
+                     if col in data]
+        return pd.DataFrame(data, columns=sorted(set(col_order),
+                                                 key=col_order.index),
+                            index=np.arange(start, stop))
+
+    def _unique(self, col):
+        chunk_uniques = [pd.unique(chunk[col])
+                         for chunk in self.iter_chunks([col])]
+        return np.unique(np.concatenate(chunk_uniques))
+
+    def _levels(self, col):
+        levels = pd.Index([], dtype=object)
+        for chunk in self.iter_chunks([col]):
+            _, levels = _append_codes(np.asarray(chunk[col]), levels)
+        return levels.values
+
+    def _add_ones_col(self, col):
+        if col not in self._ones_cols:
+            self._ones_cols.append(col)
+
+    def _table_cols(self, cols):
+        return pd.concat(list(self.iter_chunks(cols)))
+
+    def _subset_patch(self, subset, index=None):
+        """
+        Copy of patch with subset applied to each chunk as it is read
+        """
+
+        subpatch = copy.copy(self)
+        subpatch._filters = self._filters + [subset]
+        subpatch._ones_cols = list(self._ones_cols)
+        subpatch._cell_cache = {}
+        subpatch.meta, subpatch.incremented = _subset_meta(self.meta, subset,
+                                                           incremented=True)
+        return subpatch
+
+
+def _read_csv_cached(data_path):
+    """
+    Read a csv data table through a binary columnar cache next to the file
+
+    Parameters
+    ----------
+    data_path : str
+        Path to csv data file
+
+    Returns
+    -------
+    dataframe
+        Full data table, as given by pd.read_csv. When loaded from the cache,
+        numeric columns are memory mapped from it.
+
+    Notes
+    -----
+    The cache is used only if the path, size, modification time, and md5
+    hash of the csv file all match those recorded in it, and is otherwise
+    written again after parsing the csv. If the cache cannot be written, as
+    in a read only directory, the parsed table is returned with a warning.
+
+    """
+
+    cache_dir, key, manifest = _csv_cache(data_path)
+    if manifest:
         try:
-            col_names = db_info[0].keys()
-        except IndexError:
-            raise lite.OperationalError("Query %s to database %s is empty" %
-                                        (query_str, data_path))
+            return _load_cached_table(cache_dir, manifest)
+        except (IOError, ValueError) as e:
+            logging.warning('Could not load table cache %s: %s' %
+                            (cache_dir, e))
+
+    table = pd.read_csv(data_path, index_col=False)
+
+    try:
+        _write_cached_table(table, cache_dir, key)
+    except (IOError, OSError) as e:
+        logging.warning('Could not write table cache %s: %s' % (cache_dir, e))
+
+    return table
+
+
+def _read_meta(metadata_path):
+    """
+    Patch metadata read from a metadata file
+    """
+
+    meta = ConfigParser()
+    meta.read(os.path.expanduser(metadata_path))
+    return _PatchMeta(meta)
+
+
+def _meta_from_dict(meta):
+    """
+    Patch metadata from a dict of dicts, as read from a metadata file
+    """
+
+    result = {'Description': {}}
+    for section, options in (meta or {}).items():
+        result[section] = dict((key, val if isinstance(val, basestring) else
+                                repr(val)) for key, val in options.items())
+    return _PatchMeta(result)
+
+
+class _MetaSection(dict):
+    """
+    Read only dict of the option strings of one section of metadata
+
+    Attributes
+    ----------
+    min, max, step : float
+        Options of the same name parsed into floats, or None if absent
+
+    """
+
+    def __init__(self, options=()):
+        dict.__init__(self, options)
+        self.min = _meta_float(self.get('min'))
+        self.max = _meta_float(self.get('max'))
+        self.step = _meta_float(self.get('step'))
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError, "Patch metadata cannot be changed"
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
+class _PatchMeta(dict):
+    """
+    Read only dict of metadata sections, parsed once when a Patch is made
+
+    Parameters
+    ----------
+    sections : dict or ConfigParser obj
+        Dict-like of dict-like sections of option strings
+
+    Attributes
+    ----------
+    cols : dict
+        Column names given by the cols option of the Description section,
+        keyed by special column, or an empty dict if cols is absent
+
+    Notes
+    -----
+    Each section is a _MetaSection, whose min, max, and step are parsed once.
+    Metadata for a subset is made by with_options, which shares every
+    section it does not change with this metadata, so that subpatches do not
+    copy or parse the metadata again.
+
+    """
+
+    def __init__(self, sections=()):
+        if hasattr(sections, 'keys'):
+            sections = [(name, sections[name]) for name in sections.keys()]
+        dict.__init__(self, [(name, options if
+                              isinstance(options, _MetaSection) else
+                              _MetaSection(dict(options)))
+                             for name, options in sections])
+        self.cols = _parse_cols(self.get('Description', {}).get('cols', ''))
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError, "Patch metadata cannot be changed"
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def with_options(self, changes):
+        """
+        Copy of metadata with options of some sections changed
+
+        Parameters
+        ----------
+        changes : dict
+            Dicts of new option strings, keyed by section name
+
+        Returns
+        -------
+        _PatchMeta
+            Metadata sharing all sections not in changes with this metadata
+
+        """
+
+        if not changes:
+            return self
+
+        sections = dict(self)
+        for name, options in changes.items():
+            section = dict(sections[name])
+            section.update(options)
+            sections[name] = _MetaSection(section)
+        return _PatchMeta(sections)
+
+
+def _meta_float(val):
+    """
+    Metadata option string as a float, or None if val is None
+    """
+
+    if val is None:
+        return None
+    try:
+        return float(val)
+    except ValueError:
+        raise ValueError, "Metadata value %s is not a number" % repr(val)
+
+
+def _parse_cols(cols):
+    """
+    Dict of column names keyed by special column, from a cols string
+    """
+
+    cols = cols.replace(' ', '')
+    return dict(x.split(':')[:2] for x in cols.split(';') if x)
+
+
+def _frame_from_arrays(arrays, columns):
+    """
+    Dataframe whose columns are the arrays, shared rather than copied where
+    pandas allows
+
+    The dataframe is built with copy=False. Pandas versions that keep each
+    column in its own block share the arrays. Versions that consolidate
+    columns of one dtype into a single block copy them.
+    """
+
+    arrays = [np.asarray(arrays[col]) for col in columns]
+    lengths = set(len(values) for values in arrays)
+    if len(lengths) > 1:
+        raise ValueError, "Arrays must all have the same length"
+    index = pd.Index(np.arange(lengths.pop() if lengths else 0))
+
+    return pd.DataFrame(dict(zip(columns, arrays)), index=index,
+                        columns=columns, copy=False)
+
+
+def _read_csv_subset(data_path, subset, usecols=None, chunk_size=100000):
+    """
+    Read the records of a csv data file meeting subset, in chunks
+
+    Parameters
+    ----------
+    data_path : str
+        Path to csv data file
+    subset : str
+        String describing subset of data to use for analysis
+    usecols : list
+        Names of columns to keep, or None to keep all. Names not in the data
+        file are ignored.
+    chunk_size : int
+        Number of records to read at a time
+
+    Returns
+    -------
+    dataframe
+        Subtable with records from table meeting requirements in subset, and
+        the index of each record in the full table
+
+    Notes
+    -----
+    If neither subset nor usecols is given, the whole file is read at once.
+    Otherwise, only the columns kept and those tested by subset are parsed,
+    and each chunk is subset as it is read.
+
+    """
+
+    if not subset and usecols is None:
+        return pd.read_csv(data_path, index_col=False)
+
+    header = pd.read_csv(data_path, index_col=False, nrows=0).columns
+    keep = list(header) if usecols is None else [col for col in header
+                                                 if col in usecols]
+    test = _compile_subset(subset)._cols if subset else []
+    read = [col for col in header if col in keep or col in test]
+
+    chunks = []
+    start = 0
+    for chunk in pd.read_csv(data_path, index_col=False, usecols=read,
+                             chunksize=chunk_size):
+        chunk.index = np.arange(start, start + len(chunk))
+        start += len(chunk)
+        chunks.append(_subset_table(chunk, subset)[keep])
+
+    if not chunks:  # File with only a header row
+        return pd.read_csv(data_path, index_col=False, usecols=keep)
+    return pd.concat(chunks)
+
+
+def _compact_table(table, meta_cols=()):
+    """
+    Table with each column stored in the smallest type holding its values
+
+    Parameters
+    ----------
+    table : dataframe
+        Table to compact
+    meta_cols : list
+        Names of columns described in metadata, which are never made integers
+
+    Returns
+    -------
+    dataframe
+        Compact copy of table, whose memory saving is logged
+
+    """
+
+    compact = pd.DataFrame(index=table.index)
+    for col in table.columns:
+        values = table[col].values
+        kind = values.dtype.kind
+
+        if kind == 'O':
+            levels = pd.unique(values[pd.notnull(values)])
+            if len(levels) <= len(values) / 2:
+                values = pd.Categorical(values, categories=np.sort(levels),
+                                        ordered=True)
+        elif kind in 'iuf' and len(values):
+            values = _compact_numeric(values, col not in meta_cols)
+
+        compact[col] = values
+
+    before = table.memory_usage(index=False, deep=True).sum()
+    after = compact.memory_usage(index=False, deep=True).sum()
+    logging.info('Compact table uses %d bytes, %d fewer than loaded' %
+                 (after, before - after))
+
+    return compact
+
+
+def _compact_numeric(values, to_int=True):
+    """
+    Values as the smallest integer type, if to_int and all are whole
+    numbers, or as float32, if no value changes, or unchanged
+    """
+
+    whole = values.dtype.kind in 'iu' or np.all(np.mod(values, 1) == 0)
+    if to_int and whole:
+        lo, hi = values.min(), values.max()
+        for dtype in [np.int8, np.int16, np.int32, np.int64]:
+            if np.iinfo(dtype).min <= lo and hi <= np.iinfo(dtype).max:
+                return values.astype(dtype)
+
+    if values.dtype.kind == 'f' and values.dtype.itemsize > 4:
+        values32 = values.astype(np.float32)
+        same = (values32 == values) | (np.isnan(values32) & np.isnan(values))
+        if np.all(same):
+            return values32
+
+    return values
+
+
+def _needed_cols(cols, splits):
+    """
+    Names of columns given in cols and splits strings, or None if no cols
+    """
+
+    if not cols:
+        return None
+
+    names = [x.split(':')[1] for x in cols.replace(' ', '').split(';') if x]
+    if splits:
+        names += [x.split(':')[0] for x in splits.replace(' ', '').split(';')
+                  if x]
+    return names
+
+
+def _csv_cache(data_path):
+    """
+    Cache directory and key for a csv data file, and manifest of its cache
+
+    The manifest is None unless a cache matching the key exists. Contents of
+    the csv are hashed only if its path, size, and modification time match
+    the cache, so that a stale cache is usually found without reading the
+    file. If the md5 hash is not in the key, it is found when the cache is
+    written.
+    """
+
+    cache_dir = data_path + '.cache'
+    stat = os.stat(data_path)
+    key = {'path': os.path.abspath(data_path), 'size': stat.st_size,
+           'mtime': stat.st_mtime}
+
+    manifest = _read_cache_manifest(cache_dir)
+    if manifest and all(manifest.get(k) == v for k, v in key.items()):
+        key['md5'] = _file_md5(data_path)
+        if manifest.get('md5') == key['md5']:
+            return cache_dir, key, manifest
+
+    return cache_dir, key, None
+
+
+def _read_cache_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, 'manifest.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _file_md5(path, block_size=2**20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _write_cached_table(table, cache_dir, key):
+    """
+    Write each column of table to a .npy file in cache_dir
+
+    Object columns are stored as integer codes and an array of levels, so
+    that the codes can be memory mapped. The directory is written in full
+    before replacing any existing cache.
+    """
+
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(cache_dir)))
+    try:
+        kinds = []
+        for i, col in enumerate(table.columns):
+            values = table[col].values
+            if values.dtype == object:
+                values, levels = pd.factorize(values)
+                np.save(os.path.join(tmp_dir, '%d_levels.npy' % i),
+                        np.asarray(levels, dtype=object))
+                kinds.append('codes')
+            else:
+                kinds.append('values')
+            np.save(os.path.join(tmp_dir, '%d.npy' % i), values)
+
+        _finish_cache_dir(tmp_dir, cache_dir, table.columns, kinds, key)
+    except:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def _write_cached_csv(data_path, cache_dir, key, chunk_size):
+    """
+    Write each column of a csv data file to a .npy file in cache_dir
+
+    As _write_cached_table, but reading the csv in chunks of chunk_size
+    records, so that the table is never held in memory. The csv is read
+    twice, first to find the type of each column over all chunks.
+
+    Returns
+    -------
+    dict
+        Manifest of the new cache
+
+    """
+
+    n_rows = 0
+    cols = None
+    dtypes = None
+    for chunk in pd.read_csv(data_path, index_col=False, chunksize=chunk_size):
+        if cols is None:
+            cols = list(chunk.columns)
+            dtypes = [chunk[col].dtype for col in cols]
+        else:
+            dtypes = [np.result_type(dtype, chunk[col].dtype)
+                      for dtype, col in zip(dtypes, cols)]
+        n_rows += len(chunk)
+
+    # File with only a header row has no chunks, and fits in memory
+    if cols is None:
+        _write_cached_table(pd.read_csv(data_path, index_col=False),
+                            cache_dir, key)
+        return _read_cache_manifest(cache_dir)
+
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(cache_dir)))
+    try:
+        kinds = ['codes' if dtype == object else 'values' for dtype in dtypes]
+        arrays = [np.lib.format.open_memmap(
+                      os.path.join(tmp_dir, '%d.npy' % i), mode='w+',
+                      dtype=np.int64 if kind == 'codes' else dtype,
+                      shape=(n_rows,))
+                  for i, (kind, dtype) in enumerate(zip(kinds, dtypes))]
+        levels = [pd.Index([], dtype=object) for col in cols]
+
+        start = 0
+        for chunk in pd.read_csv(data_path, index_col=False,
+                                 chunksize=chunk_size):
+            stop = start + len(chunk)
+            for i, col in enumerate(cols):
+                values = chunk[col].values.astype(dtypes[i])
+                if kinds[i] == 'codes':
+                    values, levels[i] = _append_codes(values, levels[i])
+                arrays[i][start:stop] = values
+            start = stop
+
+        for i, kind in enumerate(kinds):
+            arrays[i].flush()
+            if kind == 'codes':
+                np.save(os.path.join(tmp_dir, '%d_levels.npy' % i),
+                        np.asarray(levels[i], dtype=object))
+        del arrays
+
+        _finish_cache_dir(tmp_dir, cache_dir, cols, kinds, key)
+    except:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    return _read_cache_manifest(cache_dir)
+
+
+def _append_codes(values, levels):
+    """
+    Codes of values in levels, adding new values to the end of levels
+
+    As pd.factorize over many chunks, giving codes in order of appearance
+    across all of them, and -1 for NaN.
+    """
+
+    codes = levels.get_indexer(values)
+    new = (codes < 0) & pd.notnull(values)
+    if np.any(new):
+        levels = levels.append(pd.Index(pd.factorize(values[new])[1],
+                                        dtype=object))
+        codes = levels.get_indexer(values)
+    return codes, levels
+
+
+def _finish_cache_dir(tmp_dir, cache_dir, cols, kinds, key):
+    """
+    Write column names and manifest to tmp_dir, then move it to cache_dir
+    """
+
+    if 'md5' not in key:
+        key = dict(key, md5=_file_md5(key['path']))
+
+    np.save(os.path.join(tmp_dir, 'columns.npy'),
+            np.array(list(cols), dtype=object))
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump(dict(key, kinds=kinds), f)
+
+    os.chmod(tmp_dir, 0o755)  # mkdtemp makes directory private
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+
+
+def _load_cached_columns(cache_dir, manifest):
+    """
+    Column names, memory mapped columns, and levels of columns stored as codes
+
+    Levels are None for columns stored as values.
+    """
+
+    cols = np.load(os.path.join(cache_dir, 'columns.npy'), allow_pickle=True)
+
+    arrays = []
+    levels = []
+    for i, kind in enumerate(manifest['kinds']):
+        arrays.append(np.load(os.path.join(cache_dir, '%d.npy' % i),
+                              mmap_mode='r'))
+        if kind == 'codes':
+            levels.append(np.load(os.path.join(cache_dir, '%d_levels.npy' % i),
+                                  allow_pickle=True))
+        else:
+            levels.append(None)
+
+    return list(cols), arrays, levels
 
-        # Convert objects to tuples
-        converted_info = [tuple(x) for x in db_info]
 
-        # NOTE: Using default value for Unicode: Seems better than checking
-        # lengths.  Should we keep the type as unicode?
-        dtypes=[type(x) if type(x) != unicode else 'S150' for x in db_info[0]]
+def _decode_codes(codes, levels):
+    values = np.empty(len(codes), dtype=object)
+    values[:] = np.nan
+    present = codes >= 0
+    values[present] = levels[codes[present]]
+    return values
 
-        table = np.array(converted_info, dtype=zip(col_names, dtypes))
-        con.commit()
+
+def _load_cached_table(cache_dir, manifest):
+    """
+    Load a table written by _write_cached_table, memory mapping its columns
+
+    Columns are read from the binary cache without parsing the csv. Numeric
+    columns are read only memory maps of the cache files, so that their pages
+    are read from disk only when used and are shared by all processes
+    loading the same cache. String columns are decoded from codes in memory.
+    """
+
+    cols, arrays, levels = _load_cached_columns(cache_dir, manifest)
+
+    data = {}
+    for col, values, col_levels in zip(cols, arrays, levels):
+        if col_levels is not None:
+            values = _decode_codes(values, col_levels)
+        data[col] = values
+
+    return _frame_from_arrays(data, cols)
+
+
+_db_connections = {}
+
+
+def _db_connection(data_path, extension):
+    """
+    Connection to a db file, or to an in-memory database built by a sql file
+
+    Connections are reused within a process until closed by
+    _close_db_connections, and a sql file is run again if it has been
+    modified since its database was built.
+    """
+
+    if not os.path.isfile(data_path):  # sqlite would create an empty db
+        raise IOError("Database file %s not found" % data_path)
+
+    key = (os.getpid(), os.path.abspath(data_path))
+    mtime = os.stat(data_path).st_mtime
+    if key in _db_connections:
+        con_mtime, con = _db_connections[key]
+        if extension == 'db' or con_mtime == mtime:
+            return con
         con.close()
 
-        # Return a recarray for consistency
-        # TODO: This should now be a pd.dataframe
-        return table.view(np.recarray)
+    if extension == 'sql':
+        con = sqlite3.connect(':memory:')
+        with open(data_path, 'r') as f:
+            con.executescript(f.read())
+    else:
+        con = sqlite3.connect(data_path)
+    con.text_factory = str  # Text as str, as read from csv files
+
+    _db_connections[key] = (mtime, con)
+    return con
+
+
+def _close_db_connections():
+    """
+    Close the connections opened by _db_connection in this process
+
+    Connections inherited from a parent process are forgotten but left open,
+    as they belong to the parent. Called when the interpreter exits.
+    """
+
+    pid = os.getpid()
+    for key in list(_db_connections.keys()):
+        mtime, con = _db_connections.pop(key)
+        if key[0] == pid:
+            con.close()
+
+atexit.register(_close_db_connections)
+
+
+def _db_table_name(con, data_path):
+    names = [row[0] for row in con.execute(
+        "SELECT name FROM sqlite_master WHERE type='table'")]
+    if len(names) != 1:
+        raise ValueError, ("Database %s has %d tables, give the one to use as "
+                           "table in metadata Description" %
+                           (data_path, len(names)))
+    return names[0]
+
+
+def _sql_name(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def _is_sql_query(subset):
+    return subset.lstrip()[:6].lower() == 'select'
+
+
+def _fetch_columns(con, query, params, batch_size=10000):
+    """
+    Dataframe of the result of a query, fetched in batches of records
+
+    Each batch is transposed into one array per column, so that records are
+    not kept as tuples after their batch is fetched.
+    """
+
+    cur = con.execute(query, params)
+    cols = [desc[0] for desc in cur.description]
+
+    batches = [[] for col in cols]
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        for col_batches, values in zip(batches, zip(*rows)):
+            col_batches.append(pd.Series(list(values)).values)
+    cur.close()
+
+    data = {}
+    for col, col_batches in zip(cols, batches):
+        if col_batches:
+            data[col] = np.concatenate(col_batches)
+        else:
+            data[col] = np.array([], dtype=object)
+
+    return pd.DataFrame(data, columns=cols)
 
 
 def _subset_table(full_table, subset):
@@ -292,18 +1571,7 @@ def _subset_table(full_table, subset):
     if not subset:
         return full_table
 
-    # TODO: Figure out syntax for logical or
-    conditions = subset.replace(' ','').split(';')
-
-    valid = np.ones(len(full_table), dtype=bool)
-    for condition in conditions:
-        col = re.split("[<>=!]", condition)[0]
-        comp = condition.replace(col, "")
-        try:
-            this_valid = eval("full_table['{0}']{1}".format(col, comp))
-        except KeyError as e: # catch error and redisplay for twiggy
-            raise KeyError("Column '%s' not found" % e.message)
-        valid = np.logical_and(valid, this_valid)
+    valid = _compile_subset(subset)(full_table)
 
     return full_table[valid]
 
@@ -313,8 +1581,8 @@ def _subset_meta(full_meta, subset, incremented=False):
 
     Parameters
     ----------
-    full_meta : ConfigParser obj
-        Metadata object
+    full_meta : dict
+        Patch metadata, or a ConfigParser obj to be parsed
     subset : str
         String describing subset of data to use for analysis
     incremented : bool
@@ -322,60 +1590,329 @@ def _subset_meta(full_meta, subset, incremented=False):
 
     Returns
     -------
-    Configparser object or dict
-        Updated version of full_meta accounting for subset string
+    _PatchMeta
+        Updated version of full_meta accounting for subset string, sharing
+        unchanged sections with it
 
     """
+    if not isinstance(full_meta, _PatchMeta):
+        full_meta = _PatchMeta(full_meta)
     if not subset:
         return full_meta, False
 
-    meta = {}  # Make deepcopy of entire meta (all section dicts in meta dict)
-    for key, val in full_meta.iteritems():
-        meta[key] = copy.deepcopy(dict(val))
-
-    conditions = subset.replace(' ','').split(';')
-
+    # Only comparisons that must all hold can limit a column's min and max
+    changes = {}
     inc = False
-    for condition in conditions:
-        condition_list = re.split('[<>=]', condition)
-        col = condition_list[0]
-        val = condition_list[-1]
-
-        try:
-            col_step = meta[col]['step']
-        except:  # If there's no metadata for this col, do nothing
-            continue
-
-        operator = re.sub('[^<>=]', '', condition)
-
-        if operator == '==':
-            meta[col]['min'] = val
-            meta[col]['max'] = val
-        elif operator == '>=':
-            meta[col]['min'] = val
-        elif operator == '>':
+    for col, op, value, val in _compile_subset(subset).conditions:
+
+        if col not in full_meta or full_meta[col].step is None:
+            continue  # If there's no metadata for this col, do nothing
+        col_step = full_meta[col].step
+        options = changes.setdefault(col, {})
+
+        if op == '==':
+            options['min'] = val
+            options['max'] = val
+        elif op == '>=':
+            options['min'] = val
+        elif op == '>':
             if incremented:
-                meta[col]['min'] = val
+                options['min'] = val
             else:
-                meta[col]['min'] = str(eval(val) + eval(col_step))
+                options['min'] = str(value + col_step)
             inc = True
-        elif operator == '<=':
-            meta[col]['max'] = val
-        elif operator == '<':
+        elif op == '<=':
+            options['max'] = val
+        elif op == '<':
             if incremented:
-                meta[col]['max'] = val
+                options['max'] = val
             else:
-                meta[col]['max'] = str(eval(val) - eval(col_step))
+                options['max'] = str(value - col_step)
             inc = True
-        else:
-            raise ValueError, "Subset %s not valid" % condition
 
-    return meta, inc
+    return full_meta.with_options(changes), inc
+
+
+# Names are any run of characters that are not operators, punctuation,
+# quotes, or whitespace, so that column names such as x.1, dbh-2, or 2010 are
+# accepted as before. Numbers must end where a name would.
+_subset_tokens = re.compile(r"""\s*(?:
+    (?P<str>'[^']*'|"[^"]*")|
+    (?P<num>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?
+        (?![^\s<>=!;(),\[\]'"]))|
+    (?P<name>[^\s<>=!;(),\[\]'"]+)|
+    (?P<op>==|!=|<=|>=|<|>)|
+    (?P<punct>[;(),\[\]]))""", re.VERBOSE)
+
+_subset_ops = {'==': operator.eq, '!=': operator.ne, '<': operator.lt,
+               '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+_subset_cache = {}
+
+
+def _numexpr_number(x):
+    # repr keeps all digits of floats, str drops the L of longs
+    return repr(x) if isinstance(x, float) else str(x)
+
+
+def _compile_subset(subset):
+    """
+    Compiled predicate for a subset string, cached by string
+
+    Parameters
+    ----------
+    subset : str
+        String describing subset of data to use for analysis
+
+    Returns
+    -------
+    _SubsetPredicate
+        Predicate that returns a bool array of the records of a table meeting
+        all conditions in subset
+
+    """
+
+    if subset not in _subset_cache:
+        if len(_subset_cache) >= 10000:
+            _subset_cache.clear()
+        _subset_cache[subset] = _SubsetPredicate(subset)
+    return _subset_cache[subset]
+
+
+class _SubsetPredicate(object):
+    """
+    Subset string parsed once into a tree of conditions
+
+    Parameters
+    ----------
+    subset : str
+        String describing subset of data to use for analysis
+
+    Attributes
+    ----------
+    tree : tuple
+        Nested tuples of ('and', nodes), ('or', nodes), ('cmp', col,
+        operator, value), and ('in', col, values, negate)
+    conditions : list
+        Tuples of column, operator, value, and value as written, for the
+        comparisons that all records must meet
+
+    Notes
+    -----
+    Conditions separated by semicolons (or 'and') must all hold. Conditions
+    may also be joined by 'or', grouped by parentheses, or test membership,
+    as in "spp in ('cabr', 'crcr')" or "year not in (2000, 2001)". Each
+    condition compares a column, on the left, to a number or a string. Words
+    that are not quoted are taken as strings, except True, False, and None.
+
+    If numexpr is installed and all conditions compare numeric columns to
+    numbers, the predicate is evaluated by numexpr in a single pass over large
+    tables on machines with more than one core.
+
+    """
+
+    def __init__(self, subset):
+
+        self.subset = subset
+        self._tokens = []
+        pos = 0
+        stripped = subset.rstrip()
+        while pos < len(stripped):
+            match = _subset_tokens.match(stripped, pos)
+            if not match:
+                raise ValueError, "Subset %s not valid" % subset
+            kind = match.lastgroup
+            self._tokens.append((kind, match.group(kind)))
+            pos = match.end()
+        self._pos = 0
+
+        self.tree = self._parse_expr()
+        if self._pos != len(self._tokens):
+            raise ValueError, "Subset %s not valid" % subset
+
+        self.conditions = [node[1:] for node in self._flatten_and(self.tree)
+                           if node[0] == 'cmp']
+
+        self._numexpr_str = None
+        self._cols = sorted(set(self._columns(self.tree)))
+        if numexpr is not None and self._numeric_values(self.tree):
+            names = dict((col, 'c%d' % i) for i, col in enumerate(self._cols))
+            self._numexpr_str = self._to_numexpr(self.tree, names)
+
+    def __call__(self, table):
+        """
+        Bool array giving the records of table meeting all conditions
+        """
+
+        for col in self._cols:
+            if col not in table:  # catch error and redisplay for twiggy
+                raise KeyError("Column '%s' not found" % col)
+
+        # Threaded numexpr only outpaces numpy on large tables and many cores
+        if (self._numexpr_str is not None and len(table) >= 100000 and
+                numexpr.detect_number_of_cores() > 1 and
+                all(table[col].dtype.kind in 'iuf' for col in self._cols)):
+            local_dict = dict(('c%d' % i, np.asarray(table[col])) for i, col
+                              in enumerate(self._cols))
+            return numexpr.evaluate(self._numexpr_str, local_dict=local_dict)
+
+        return self._evaluate(self.tree, table)
+
+    def to_sql(self):
+        """
+        SQL WHERE clause for the predicate, with ? for each value, and the
+        list of values
+        """
+        params = []
+        return self._to_sql(self.tree, params), params
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return (None, None)
+
+    def _next(self, kind=None, text=None):
+        token = self._peek()
+        if token[0] is None or (kind and token[0] != kind) or \
+                (text and token[1] != text):
+            raise ValueError, "Subset %s not valid" % self.subset
+        self._pos += 1
+        return token
+
+    def _parse_expr(self):
+        nodes = [self._parse_or()]
+        while self._peek() == ('punct', ';'):
+            self._next()
+            if self._peek()[0] is None or self._peek() == ('punct', ')'):
+                break  # Allow trailing semicolon
+            nodes.append(self._parse_or())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def _parse_or(self):
+        nodes = [self._parse_and()]
+        while self._peek() == ('name', 'or'):
+            self._next()
+            nodes.append(self._parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def _parse_and(self):
+        nodes = [self._parse_condition()]
+        while self._peek() == ('name', 'and'):
+            self._next()
+            nodes.append(self._parse_condition())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def _parse_condition(self):
+        if self._peek() == ('punct', '('):
+            self._next()
+            node = self._parse_expr()
+            self._next('punct', ')')
+            return node
+
+        # Column names may look like numbers, as in 2010>3
+        kind, col = self._next()
+        if kind not in ('name', 'num'):
+            raise ValueError, "Subset %s not valid" % self.subset
+        kind, text = self._next()
+
+        if kind == 'op':
+            value, val = self._parse_value()
+            return ('cmp', col, text, value, val)
+
+        negate = (kind, text) == ('name', 'not')
+        if negate:
+            kind, text = self._next()
+        if (kind, text) != ('name', 'in'):
+            raise ValueError, "Subset %s not valid" % self.subset
+
+        close = {'(': ')', '[': ']'}[self._next('punct')[1]]
+        values = [self._parse_value()[0]]
+        while self._peek() == ('punct', ','):
+            self._next()
+            if self._peek() == ('punct', close):
+                break  # Allow trailing comma
+            values.append(self._parse_value()[0])
+        self._next('punct', close)
+        return ('in', col, values, negate)
+
+    def _parse_value(self):
+        kind, text = self._next()
+        if kind == 'str':
+            return text[1:-1], text
+        elif kind == 'num':
+            try:
+                return int(text), text
+            except ValueError:
+                return float(text), text
+        elif kind == 'name':
+            return {'True': True, 'False': False,
+                    'None': None}.get(text, text), text
+        raise ValueError, "Subset %s not valid" % self.subset
+
+    def _flatten_and(self, node):
+        if node[0] == 'and':
+            return [x for child in node[1] for x in self._flatten_and(child)]
+        return [node]
+
+    def _columns(self, node):
+        if node[0] in ('and', 'or'):
+            return [x for child in node[1] for x in self._columns(child)]
+        return [node[1]]
+
+    def _numeric_values(self, node):
+        if node[0] in ('and', 'or'):
+            return all(self._numeric_values(child) for child in node[1])
+        values = [node[3]] if node[0] == 'cmp' else node[2]
+        return all(isinstance(x, (int, long, float)) and
+                   not isinstance(x, bool) for x in values)
+
+    def _to_numexpr(self, node, names):
+        if node[0] in ('and', 'or'):
+            joiner = ' & ' if node[0] == 'and' else ' | '
+            return '(' + joiner.join(self._to_numexpr(child, names)
+                                     for child in node[1]) + ')'
+        elif node[0] == 'cmp':
+            return '(%s %s %s)' % (names[node[1]], node[2],
+                                   _numexpr_number(node[3]))
+        else:
+            expr = '(' + ' | '.join('(%s == %s)' % (names[node[1]],
+                                                    _numexpr_number(x))
+                                    for x in node[2]) + ')'
+            return '~' + expr if node[3] else expr
+
+    def _to_sql(self, node, params):
+        if node[0] in ('and', 'or'):
+            joiner = ' AND ' if node[0] == 'and' else ' OR '
+            return '(' + joiner.join([self._to_sql(child, params)
+                                      for child in node[1]]) + ')'
+        elif node[0] == 'cmp':
+            params.append(node[3])
+            return '(%s %s ?)' % (_sql_name(node[1]), node[2])
+        else:
+            params.extend(node[2])
+            return '(%s %sIN (%s))' % (_sql_name(node[1]),
+                                       'NOT ' if node[3] else '',
+                                       ', '.join('?' * len(node[2])))
+
+    def _evaluate(self, node, table):
+        if node[0] == 'and':
+            return reduce(np.logical_and,
+                          [self._evaluate(child, table) for child in node[1]])
+        elif node[0] == 'or':
+            return reduce(np.logical_or,
+                          [self._evaluate(child, table) for child in node[1]])
+        elif node[0] == 'cmp':
+            return np.asarray(_subset_ops[node[2]](table[node[1]], node[3]),
+                              dtype=bool)
+        else:
+            valid = np.asarray(table[node[1]].isin(node[2]), dtype=bool)
+            return ~valid if node[3] else valid
 
 
 @log_start_end
-@doc_sub(metric_params, metric_return, cols_note, splits_note, start_emp_example)
-def sad(patch, cols, splits, clean=True):
+@doc_sub(metric_params, metric_return, cols_note, splits_note, start_emp_example,
+         n_jobs_param)
+def sad(patch, cols, splits, clean=True, n_jobs=1):
     """
     Calculates an empirical species abundance distribution
 
@@ -385,6 +1922,7 @@ def sad(patch, cols, splits, clean=True):
     clean : bool
         If True, all species with zero abundance are removed from SAD results.
         Default False.
+    {5}
 
     Returns
     -------
@@ -477,42 +2015,43 @@ def sad(patch, cols, splits, clean=True):
     (spp_col, count_col), patch = \
         _get_cols(['spp_col', 'count_col'], cols, patch)
 
-    full_spp_list = np.unique(patch.table[spp_col])
+    # Factorize species once, so that each split needs only a bincount
+    full_spp_list = patch._unique(spp_col)
 
-    # Loop through each split
-    result_list = []
-    for substring, subpatch in _yield_subpatches(patch, splits):
+    # Get result for each split
+    return _map_subpatches(_sad_split, patch, splits, n_jobs,
+                           (spp_col, count_col, full_spp_list, clean))
 
-        # Get abundance for each species
-        sad_list = []
-        for spp in full_spp_list:
-            this_spp = (subpatch.table[spp_col] == spp)
-            count = np.sum(subpatch.table[count_col][this_spp])
-            sad_list.append(count)
 
-        # Create dataframe of spp names and abundances
-        subdf = pd.DataFrame({'spp': full_spp_list, 'y': sad_list})
+def _sad_split(subpatch, spp_col, count_col, full_spp_list, clean):
 
-        # Remove zero abundance rows if requested
-        if clean:
-            subdf = subdf[subdf['y'] > 0]
+    # Get abundance for each species, summed over chunks of records
+    sad_list = 0
+    for chunk in subpatch.iter_chunks([spp_col, count_col]):
+        sad_list = sad_list + _spp_abundances(chunk[spp_col],
+                                              chunk[count_col], full_spp_list)
 
-        # Append subset result
-        result_list.append((substring, subdf))
+    # Create dataframe of spp names and abundances
+    subdf = pd.DataFrame({'spp': full_spp_list, 'y': sad_list})
 
-    # Return all results
-    return result_list
+    # Remove zero abundance rows if requested
+    if clean:
+        subdf = subdf[subdf['y'] > 0]
+
+    return subdf
 
 
 @log_start_end
-@doc_sub(metric_params, metric_return, cols_note, splits_note, start_emp_example)
-def ssad(patch, cols, splits):
+@doc_sub(metric_params, metric_return, cols_note, splits_note, start_emp_example,
+         n_jobs_param)
+def ssad(patch, cols, splits, n_jobs=1):
     """
     Calculates an empirical intra-specific spatial abundance distribution
 
     Parameters
     ----------
     {0}
+    {5}
 
     Returns
     -------
@@ -565,7 +2104,7 @@ def ssad(patch, cols, splits):
     """
 
     # Get and check SAD
-    sad_results = sad(patch, cols, splits, clean=False)
+    sad_results = sad(patch, cols, splits, clean=False, n_jobs=n_jobs)
 
     # Create dataframe with col for spp name and numbered col for each split
     for i, sad_result in enumerate(sad_results):
@@ -587,8 +2126,8 @@ def ssad(patch, cols, splits):
 
 @log_start_end
 @doc_sub(metric_params, metric_return, cols_note, splits_note, division_note,
-            start_emp_example)
-def sar(patch, cols, splits, divs, ear=False):
+            start_emp_example, n_jobs_param)
+def sar(patch, cols, splits, divs, ear=False, n_jobs=1):
     """
     Calculates an empirical species area or endemics area relationship
 
@@ -599,6 +2138,7 @@ def sar(patch, cols, splits, divs, ear=False):
         Description of how to divide x_col and y_col. See notes.
     ear : bool
         If True, calculates an endemics area relationship
+    {6}
 
     Returns
     -------
@@ -652,28 +2192,27 @@ def sar(patch, cols, splits, divs, ear=False):
 
     """
 
-    def sar_y_func(spatial_table, all_spp):
-        return np.mean(spatial_table['n_spp'])
-
-    def ear_y_func(spatial_table, all_spp):
-        endemic_counter = 0
-        for spp in all_spp:
-            spp_in_cell = [spp in x for x in spatial_table['spp_set']]
-            spp_n_cells = np.sum(spp_in_cell)
-            if spp_n_cells == 1:  # If a spp is in only 1 cell, endemic
-                endemic_counter += 1
-        n_cells = len(spatial_table)
-        return endemic_counter / n_cells # mean endemics / cell
-
     if ear:
-        y_func = ear_y_func
+        y_func = _ear_y_func
     else:
-        y_func = sar_y_func
+        y_func = _sar_y_func
+
+    return _sar_ear_inner(patch, cols, splits, divs, y_func, n_jobs)
+
 
-    return _sar_ear_inner(patch, cols, splits, divs, y_func)
+def _sar_y_func(spatial_table, spp_pres):
+    return np.mean(spatial_table['n_spp'])
 
 
-def _sar_ear_inner(patch, cols, splits, divs, y_func):
+def _ear_y_func(spatial_table, spp_pres):
+    # Presence matrix is species by cell, so row counts give occupancy
+    spp_n_cells = np.diff(spp_pres.tocsr().indptr)
+    endemic_counter = np.sum(spp_n_cells == 1)  # Spp in only 1 cell
+    n_cells = spp_pres.shape[1]
+    return endemic_counter / n_cells # mean endemics / cell
+
+
+def _sar_ear_inner(patch, cols, splits, divs, y_func, n_jobs=1):
     """
     y_func is function calculating the mean number of species or endemics,
     respectively, for the SAR or EAR
@@ -682,35 +2221,44 @@ def _sar_ear_inner(patch, cols, splits, divs, y_func):
     (spp_col, count_col, x_col, y_col), patch = \
         _get_cols(['spp_col', 'count_col', 'x_col', 'y_col'], cols, patch)
 
-    # Loop through each split
-    result_list = []
-    for substring, subpatch in _yield_subpatches(patch, splits):
-
-        # Get A0
-        A0 = _patch_area(subpatch, x_col, y_col)
-
-        # Loop through all divisions within this split
-        all_spp = np.unique(subpatch.table[spp_col])
-        subresultx = []
-        subresulty = []
-        subresultnspp = []
-        subresultnindivids = []
-        subdivlist = _split_divs(divs)
-        for subdiv in subdivlist:
-            spatial_table = _yield_spatial_table(subpatch, subdiv, spp_col,
-                                        count_col, x_col, y_col)
-            subresulty.append(y_func(spatial_table, all_spp))
-            subresultx.append(A0 / eval(subdiv.replace(',', '*')))
-            subresultnspp.append(np.mean(spatial_table['n_spp']))
-            subresultnindivids.append(np.mean(spatial_table['n_individs']))
-
-        # Append subset result
-        subresult = pd.DataFrame({'div': subdivlist, 'x': subresultx,
-                                  'y': subresulty, 'n_spp': subresultnspp,
-                                  'n_individs': subresultnindivids})
-        result_list.append((substring, subresult))
+    subdivlist = _split_divs(divs)
 
-    return result_list
+    # Get result for each split
+    return _map_subpatches(_sar_ear_split, patch, splits, n_jobs,
+                           (spp_col, count_col, x_col, y_col, subdivlist,
+                            y_func))
+
+
+def _sar_ear_split(subpatch, spp_col, count_col, x_col, y_col, subdivlist,
+                   y_func):
+
+    # Get A0
+    A0 = _patch_area(subpatch, x_col, y_col)
+
+    # Build species by cell matrices for all divisions, finest first, so that
+    # nested coarser ones sum their cells
+    n_cells = lambda div: np.prod([eval(x) for x in _div_split_list(div)])
+    for subdiv in sorted(subdivlist, key=n_cells, reverse=True):
+        subpatch._cell_matrix(subdiv, spp_col, count_col, x_col, y_col)
+
+    # Loop through all divisions within this split
+    subresultx = []
+    subresulty = []
+    subresultnspp = []
+    subresultnindivids = []
+    for subdiv in subdivlist:
+        spatial_table = _yield_spatial_table(subpatch, subdiv, spp_col,
+                                    count_col, x_col, y_col)
+        _, _, spp_pres = subpatch._cell_matrix(subdiv, spp_col, count_col,
+                                               x_col, y_col)
+        subresulty.append(y_func(spatial_table, spp_pres))
+        subresultx.append(A0 / eval(subdiv.replace(',', '*')))
+        subresultnspp.append(np.mean(spatial_table['n_spp']))
+        subresultnindivids.append(np.mean(spatial_table['n_individs']))
+
+    return pd.DataFrame({'div': subdivlist, 'x': subresultx,
+                         'y': subresulty, 'n_spp': subresultnspp,
+                         'n_individs': subresultnindivids})
 
 
 def _split_divs(divs):
@@ -725,8 +2273,9 @@ def _split_divs(divs):
 
 
 @log_start_end
-@doc_sub(metric_params, metric_return, cols_note, splits_note)
-def comm_grid(patch, cols, splits, divs, metric='Sorensen'):
+@doc_sub(metric_params, metric_return, cols_note, splits_note, n_jobs_param)
+def comm_grid(patch, cols, splits, divs, metric='Sorensen', output='pair',
+              bin_edges=None, n_jobs=1):
     """
     Calculates commonality as a function of distance for a gridded patch
 
@@ -739,12 +2288,23 @@ def comm_grid(patch, cols, splits, divs, metric='Sorensen'):
     metric : str
         One of Sorensen or Jaccard, giving the metric to use for commonality
         calculation
+    output : str
+        One of pair, xy, or dist_class, giving the form of the result. See
+        Returns. Default pair.
+    bin_edges : iterable
+        List of edges of distance classes, required if output is dist_class
+    {4}
 
     Returns
     -------
-    {1} Result has three columns, pair, x, and y, that give the locations of
-    the pair of patches for which commonality is calculated, the distance
-    between those cells, and the Sorensen or Jaccard result.
+    {1} If output is pair, result has three columns, pair, x, and y, that give
+    the locations of the pair of patches for which commonality is calculated,
+    the distance between those cells, and the Sorensen or Jaccard result. If
+    output is xy, the pair column is replaced by four numeric columns, x1, y1,
+    x2, and y2, giving the locations of the two cells. If output is
+    dist_class, result has one row per distance class and four columns, x, y,
+    var, and n, that give the center of the class and the mean, variance, and
+    number of pairwise commonalities in that class.
 
     Notes
     -----
@@ -755,53 +2315,188 @@ def comm_grid(patch, cols, splits, divs, metric='Sorensen'):
 
     {3}
 
+    When output is dist_class, pairs are summarized as they are computed, so
+    that the full table of pairs is never held in memory. Distance classes
+    include the lower edge and exclude the upper edge, except for the final
+    class which includes both edges. Pairs of two empty cells, for which
+    commonality is undefined, are not included in any class.
+
     """
 
     (spp_col, count_col, x_col, y_col), patch = \
         _get_cols(['spp_col', 'count_col', 'x_col', 'y_col'], cols, patch)
 
-    # Loop through each split
-    result_list = []
-    for substring, subpatch in _yield_subpatches(patch, splits):
-
-        # Get spatial table and break out columns
-        spatial_table = _yield_spatial_table(subpatch, divs, spp_col,
-                                             count_col, x_col, y_col)
-        spp_set = spatial_table['spp_set']
-        cell_loc = spatial_table['cell_loc']
-        n_spp = spatial_table['n_spp']
-
-        # Get all possible pairwise combinations of cells
-        pair_list = []
-        dist_list = []
-        comm_list = []
-        for i in range(len(spatial_table)):
-            for j in range(i+1, len(spatial_table)):
-
-                iloc = np.round(cell_loc[i], 6)
-                jloc = np.round(cell_loc[j], 6)
-                pair_list.append('('+str(iloc[0])+' '+str(iloc[1])+') - '+
-                                 '('+str(jloc[0])+' '+str(jloc[1])+')')
-
-                dist_list.append(_distance(cell_loc[i], cell_loc[j]))
-
-                ij_intersect = spp_set[i] & spp_set[j]
-                if metric.lower() == 'sorensen':
-                    comm = 2*len(ij_intersect) / (n_spp[i] + n_spp[j])
-                elif metric.lower() == 'jaccard':
-                    comm = len(ij_intersect) / len(spp_set[i] | spp_set[j])
-                else:
-                    raise ValueError, ("Only Sorensen and Jaccard metrics are "
-                                      "available for gridded commonality")
-                comm_list.append(comm)
-
-        # Append subset result
-        subresult = pd.DataFrame({'pair': pair_list, 'x': dist_list,
-                                  'y': comm_list})
-        result_list.append((substring, subresult))
+    if metric.lower() not in ['sorensen', 'jaccard']:
+        raise ValueError, ("Only Sorensen and Jaccard metrics are "
+                          "available for gridded commonality")
+    if output not in ['pair', 'xy', 'dist_class']:
+        raise ValueError, "output must be one of pair, xy, or dist_class"
+    if output == 'dist_class' and bin_edges is None:
+        raise ValueError, "bin_edges must be given if output is dist_class"
+
+    # Get result for each split
+    return _map_subpatches(_comm_grid_split, patch, splits, n_jobs,
+                           (spp_col, count_col, x_col, y_col, divs, metric,
+                            output, bin_edges))
+
+
+def _comm_grid_split(subpatch, spp_col, count_col, x_col, y_col, divs, metric,
+                     output, bin_edges):
+
+    # Get spatial table and species by cell presence matrix
+    spatial_table = _yield_spatial_table(subpatch, divs, spp_col,
+                                         count_col, x_col, y_col)
+    cell_loc = np.array(list(spatial_table['cell_loc']))
+    _, _, spp_pres = subpatch._cell_matrix(divs, spp_col, count_col,
+                                           x_col, y_col)
+    pair_blocks = _yield_cell_pairs(spp_pres, cell_loc, metric)
+
+    # Summarize distance classes without keeping pairs
+    if output == 'dist_class':
+        return _dist_class_summary(pair_blocks, bin_edges)
+
+    # Label each cell once, to be joined into labels of pairs
+    if output == 'pair':
+        cell_labels = np.array(['(' + str(x) + ' ' + str(y) + ')' for x, y
+                                in np.round(cell_loc, 6)], dtype=object)
+
+    # Get all possible pairwise combinations of cells, a block at a time
+    i_list = []
+    j_list = []
+    dist_list = []
+    comm_list = []
+    for i, j, dists, comms in pair_blocks:
+        i_list.append(i)
+        j_list.append(j)
+        dist_list.append(dists)
+        comm_list.append(comms)
+    i = np.concatenate(i_list)
+    j = np.concatenate(j_list)
+
+    subresult = pd.DataFrame({'x': np.concatenate(dist_list),
+                              'y': np.concatenate(comm_list)})
+    if output == 'pair':
+        subresult.insert(0, 'pair', cell_labels[i] + ' - ' + cell_labels[j])
+    else:
+        subresult.insert(0, 'x1', cell_loc[i, 0])
+        subresult.insert(1, 'y1', cell_loc[i, 1])
+        subresult.insert(2, 'x2', cell_loc[j, 0])
+        subresult.insert(3, 'y2', cell_loc[j, 1])
 
-    # Return all results
-    return result_list
+    return subresult
+
+
+def _yield_cell_pairs(spp_pres, cell_loc, metric, block_size=None):
+    """
+    Distance and commonality for all pairs of cells, in blocks of rows
+
+    Parameters
+    ----------
+    spp_pres : sparse matrix
+        Species by cell presence matrix from Patch._cell_matrix
+    cell_loc : ndarray
+        Array of shape (n cells, 2) giving the location of each cell
+    metric : str
+        Sorensen or Jaccard
+    block_size : int
+        Number of cells, i.e. rows of the pairwise matrix, in each block. By
+        default, blocks are sized to hold about 4 million pairs.
+
+    Yields
+    ------
+    tuple
+        Arrays of first cell index, second cell index, distance, and
+        commonality for each pair in a block. Pairs (i, j) with i < j are
+        yielded in order of i then j.
+
+    """
+
+    n_cells = spp_pres.shape[1]
+    if block_size is None:
+        block_size = max(1, 2**22 // max(n_cells, 1))
+
+    # Intersections of all pairs are the product of cells by species matrix
+    # with its transpose
+    cell_pres = spp_pres.T.tocsr().astype(np.int64)
+    n_spp = np.diff(cell_pres.indptr)
+
+    for start in range(0, n_cells, block_size):
+        rows = np.arange(start, min(start + block_size, n_cells))
+
+        # Pairs in block, as upper triangle of block rows by all cells
+        upper = np.arange(n_cells)[np.newaxis, :] > rows[:, np.newaxis]
+        i, j = np.nonzero(upper)
+        i += start
+
+        intersect = cell_pres[rows].dot(cell_pres.T).toarray()[upper]
+        dists = dist.cdist(cell_loc[rows], cell_loc)[upper]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if metric.lower() == 'sorensen':
+                comms = 2 * intersect / (n_spp[i] + n_spp[j])
+            else:
+                comms = intersect / (n_spp[i] + n_spp[j] - intersect)
+
+        yield i, j, dists, comms
+
+
+def _dist_class_summary(pair_blocks, bin_edges):
+    """
+    Mean, variance, and number of commonalities in each distance class
+
+    Parameters
+    ----------
+    pair_blocks : iterable
+        Blocks of pairs, as yielded by _yield_cell_pairs
+    bin_edges : iterable
+        List of edges of distance classes
+
+    Returns
+    -------
+    DataFrame
+        Columns x, y, var, and n giving the center of each class and the
+        mean, variance, and number of finite commonalities in the class
+
+    Notes
+    -----
+    Statistics of each block are merged into running totals with the
+    pairwise update of Chan et al., so that pairs need not be stored.
+
+    """
+
+    bin_edges = np.array(bin_edges, dtype=float)
+    n_bins = len(bin_edges) - 1
+
+    n = np.zeros(n_bins)
+    mean = np.zeros(n_bins)
+    m2 = np.zeros(n_bins)  # Sum of squared deviations from mean
+    for _, _, dists, comms in pair_blocks:
+
+        bins = _hist_bins(dists, bin_edges)
+        keep = (bins >= 0) & np.isfinite(comms)
+        bins = bins[keep]
+        comms = comms[keep]
+
+        block_n = np.bincount(bins, minlength=n_bins)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            block_mean = np.bincount(bins, comms, n_bins) / block_n
+        block_m2 = np.bincount(bins, (comms - block_mean[bins])**2, n_bins)
+
+        has_pairs = block_n > 0
+        total_n = n + block_n
+        delta = block_mean - mean
+        mean[has_pairs] += (delta * block_n / total_n)[has_pairs]
+        m2[has_pairs] += (block_m2 + delta**2 * n * block_n /
+                          total_n)[has_pairs]
+        n = total_n
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = m2 / n
+    mean[n == 0] = np.nan
+
+    return pd.DataFrame({'x': (bin_edges[:-1] + bin_edges[1:]) / 2,
+                         'y': mean, 'var': var, 'n': n.astype(int)},
+                        columns=['x', 'y', 'var', 'n'])
 
 
 def _yield_spatial_table(patch, div, spp_col, count_col, x_col, y_col):
@@ -818,18 +2513,12 @@ def _yield_spatial_table(patch, div, spp_col, count_col, x_col, y_col):
     The spatial table is the precursor to the SAR, EAR, and grid-based
     commonality metrics. Each row in the table corresponds to a cell created by
     a given division. Columns are cell_loc (within the grid defined by the
-    division), spp_set, n_spp, and n_individs.
+    division), n_spp, and n_individs. The species found in each cell are given
+    by the presence matrix from Patch._cell_matrix.
 
     """
 
-    # Catch error if you don't use ; after divs in comm_grid in MacroecoDesktop
-    try:
-        div_split_list = div.replace(';','').split(',')
-    except AttributeError:
-        div_split_list = str(div).strip("()").split(',')
-
-    div_split = (x_col + ':' + div_split_list[0] + ';' +
-                 y_col + ':' + div_split_list[1])
+    div_split_list = _div_split_list(div)
 
     # Get cell_locs
     # Requires _parse_splits and _product functions to go y inside of x
@@ -843,47 +2532,54 @@ def _yield_spatial_table(patch, div, spp_col, count_col, x_col, y_col):
 
     cell_locs = _product(x_locs, y_locs)
 
-    # Get spp set and count for all cells
-    n_spp_list = [] # Number of species in cell
-    n_individs_list = []
-    spp_set_list = []   # Set object giving unique species IDs in cell
-    for cellstring, cellpatch in _yield_subpatches(patch,div_split,name='div'):
-        spp_set = set(np.unique(cellpatch.table[spp_col]))
-        spp_set_list.append(spp_set)
-        n_spp_list.append(len(spp_set))
-        n_individs_list.append(np.sum(cellpatch.table[count_col]))
+    # Get spp and individual counts for all cells from species by cell matrices
+    _, abund, pres = patch._cell_matrix(div, spp_col, count_col, x_col, y_col)
+    n_spp_list = np.diff(pres.tocsc().indptr)  # Number of species in cell
+    n_individs_list = abund.T.dot(np.ones(abund.shape[0], dtype=abund.dtype))
 
     # Create and return dataframe
-    df = pd.DataFrame({'cell_loc': cell_locs, 'spp_set': spp_set_list,
-                       'n_spp': n_spp_list, 'n_individs': n_individs_list})
+    df = pd.DataFrame({'cell_loc': cell_locs, 'n_spp': n_spp_list,
+                       'n_individs': n_individs_list})
 
     return df
 
 
 @log_start_end
-@doc_sub(metric_params, metric_return, cols_note, splits_note)
-def o_ring(patch, cols, splits, spp, bin_edges, density=True, full=False):
+@doc_sub(metric_params, metric_return, cols_note, splits_note, n_jobs_param)
+def o_ring(patch, cols, splits, spp, bin_edges, density=True, full=False,
+           pairs=None, n_jobs=1):
     """
-    Calculates univariate O-ring for a species
+    Calculates univariate O-ring for a species, or for many species at once
 
     Parameters
     ----------
     {0}
     bin_edges : iterable
         List of edges of distance classes to bin histogram of distances
-    spp : str
-        String corresponding to focal species code
+    spp : str, list, or None
+        String corresponding to focal species code, list of species codes, or
+        None to use all species in the patch
     density : bool
         If True, return densities (counts divided by area of torus defined
         by bin edges) instead of counts. Default True.
     full : bool
         If True, return a separate column giving density at distance x for
-        every individual, rather than mean density. Default False.
+        every individual, rather than mean density. Default False. Only
+        available for a single species.
+    pairs : list
+        Optional list of (focal, target) tuples of species codes for which to
+        calculate bivariate O-rings, giving the number or density of target
+        individuals around focal individuals. Default None.
+    {4}
 
     Returns
     -------
-    {1} Result has two columns, x and y, that give the distance to the center
-    of a torus and the number or density of individuals found in that torus.
+    {1} For a single species, result has two columns, x and y, that give the
+    distance to the center of a torus and the number or density of
+    individuals found in that torus. If spp is a list or None, or if pairs is
+    given, result has columns focal, target, x, and y, with one set of rows
+    for each univariate O-ring (where focal and target are the same species)
+    followed by one for each bivariate O-ring.
 
     Notes
     -----
@@ -900,7 +2596,13 @@ def o_ring(patch, cols, splits, spp, bin_edges, density=True, full=False):
 
     If there are no records for a species, result table will be a dataframe
     with no records. If there are records but a species has only one
-    individual, dataframe will have zero count at all torus areas.
+    individual, dataframe will have zero count at all torus areas. For many
+    species, O-rings with no focal individuals are left out of the result.
+
+    Bivariate counts include all pairs of focal and target individuals, and
+    densities are edge corrected around focal individuals. For many species,
+    the tree and edge correction for each species are found once per split
+    and shared by all of its O-rings.
 
     When using density, the maximum distance used for edge correction, given by
     the mean of the last two bin_edge values, should ideally be set to no
@@ -917,114 +2619,231 @@ def o_ring(patch, cols, splits, spp, bin_edges, density=True, full=False):
 
     """
 
-    try:
-        geo.box(0, 0, 1, 1)
-    except:
-        raise ImportError, "O-ring analysis requires shapely package"
-
     (spp_col, count_col, x_col, y_col), patch = \
         _get_cols(['spp_col', 'count_col', 'x_col', 'y_col'], cols, patch)
 
-    # Loop through each split
-    result_list = []
-    for substring, subpatch in _yield_subpatches(patch, splits):
-
-        # Get table for just this species
-        spp_table = subpatch.table[subpatch.table[spp_col] == spp]
-
-        # If spp not present, continue
-        if (len(spp_table) == 0):
-            result_list.append((substring, pd.DataFrame(columns=['x','y'])))
+    # Univariate O-rings are pairs of a species with itself
+    batch = not isinstance(spp, basestring) or pairs is not None
+    if spp is None:
+        spp = patch._unique(spp_col)
+    elif isinstance(spp, basestring):
+        spp = [spp]
+    focal_targets = [(x, x) for x in spp] + [tuple(x) for x in (pairs or [])]
+
+    if full and batch:
+        raise ValueError, "full is only available for a single species"
+
+    # Get result for each split
+    return _map_subpatches(_o_ring_split, patch, splits, n_jobs,
+                           (spp_col, count_col, x_col, y_col, focal_targets,
+                            bin_edges, density, full, batch))
+
+
+def _o_ring_split(subpatch, spp_col, count_col, x_col, y_col, focal_targets,
+                  bin_edges, density, full, batch):
+
+    # Set up plot geometry
+    plot, radii, torus_areas = \
+        _get_plot_geometry(subpatch, bin_edges, x_col, y_col)
+
+    # Tree, counts, and edge corrected areas for each species present
+    focal_spp = set([focal for focal, target in focal_targets])
+    table = subpatch._table_cols([spp_col, count_col, x_col, y_col])
+    spp_rows = table.groupby(spp_col).indices
+    spp_points = {}
+    for name in set(itertools.chain(*focal_targets)):
+        if name not in spp_rows:
             continue
+        spp_table = table.iloc[spp_rows[name]]
+        points = np.array(spp_table[[x_col, y_col]], dtype=float)
+        counts = _wide_counts(spp_table[count_col])
+
+        areas = None
+        if density and name in focal_spp:
+            corr_factors = _edge_correction(points, radii, plot)
+            areas = torus_areas * corr_factors * counts[:, np.newaxis]
+            if not full:
+                areas = np.sum(areas, axis=0)
 
-        # Set up plot geometry
-        plot_poly, radii, torus_areas = \
-            _get_plot_geometry(subpatch, bin_edges, x_col, y_col)
+        spp_points[name] = (cKDTree(points), counts, areas)
 
-        # Get lists of all points and counts in spp_table
-        x = spp_table[x_col]
-        y = spp_table[y_col]
-        points = zip(x,y)
-        counts = list(spp_table[count_col])
+    subresults = []
+    for focal, target in focal_targets:
 
-        # Arrays to hold summed areas and distance histograms for all points
+        # If focal spp not present, continue
+        if focal not in spp_points:
+            continue
+        tree, counts, areas = spp_points[focal]
 
+        # Histograms of distances between individuals, weighted by counts
         if full:
-            hists = []  # Vectors of len(radii) appended for each point
-            areas = []
+            hists = _ring_counts_by_point(tree, counts, bin_edges)
+        elif focal == target:
+            hists = _ring_counts(tree, counts, bin_edges)
+        elif target in spp_points:
+            target_tree, target_counts, _ = spp_points[target]
+            hists = _ring_counts(tree, counts, bin_edges,
+                                 target_tree, target_counts)
         else:
             hists = np.zeros(len(radii))
-            areas = np.zeros(len(radii))
 
-        # Go through each point and associated count
-        for i, (point, count) in enumerate(zip(points, counts)):
+        # If density, divide torus counts by edge corrected torus areas
+        if density:
+            hists = hists / areas
 
-            # Create list of all other points and counts except this
-            other_points = points[0:i] + points[i+1:]
-            other_counts = counts[0:i] + counts[i+1:]
+        subresult = pd.DataFrame({'x': radii})
+        if full:
+            for i in range(len(hists)):
+                subresult[i] = hists[i]
+        else:
+            subresult['y'] = hists
+        if batch:
+            subresult.insert(0, 'focal', focal)
+            subresult.insert(1, 'target', target)
+        subresults.append(subresult)
+
+    if subresults:
+        return pd.concat(subresults, ignore_index=True)
+    elif batch:
+        return pd.DataFrame(columns=['focal', 'target', 'x', 'y'])
+    else:
+        return pd.DataFrame(columns=['x', 'y'])
 
-            # Get dist from this point to all other points
-            if other_points:
-                other_dists = dist.cdist(np.array([point]),
-                                         np.array(other_points))
-            else:
-                other_dists = np.array(())
 
-            # Repeat other point distances to acccount for their counts
-            other_dists = np.repeat(other_dists, other_counts)
+def _ring_counts(tree, counts, bin_edges, other_tree=None, other_counts=None):
+    """
+    Number of ordered pairs of individuals separated by a distance in each bin
 
-            # Repeat entire other_dist array to account for count here
-            other_dists = np.tile(other_dists, count)
+    Parameters
+    ----------
+    tree : cKDTree
+        Tree of locations of points
+    counts : ndarray
+        Number of individuals at each point
+    bin_edges : iterable
+        List of edges of distance classes
+    other_tree, other_counts : cKDTree, ndarray
+        Optional tree and counts of a second set of individuals. If given,
+        pairs are between individuals in tree and those in other_tree.
 
-            # Add 0's for count at this point to account for count here
-            if count > 1:
-                other_dists = np.concatenate((other_dists,
-                                              np.zeros(count*(count-1))))
+    Returns
+    -------
+    ndarray
+        Summed histogram of distances from every individual to all others,
+        with individuals at the same point separated by distance zero
 
-            # Calculate histogram of distances to other points
-            hist, _ = np.histogram(other_dists, bin_edges)
+    Notes
+    -----
+    Uses weighted cumulative neighbor counts from the tree, so pairs are
+    never enumerated. Bins follow np.histogram, including the lower edge and
+    excluding the upper edge, except for the final bin.
 
-            # Convert histogram to density if desired
-            corr_factor = np.ones(len(radii))  # Frac length in plot
-            for j, r in enumerate(radii):
-                circ = geo.Point(*point).buffer(r, resolution=64)
-                outside_len = circ.boundary.difference(plot_poly).length
-                corr_factor[j] = ((circ.boundary.length - outside_len) /
-                                   circ.boundary.length)
-
-            # Add hist and corrected area for this point to running totals
-            if full:
-                hists.append(hist)
-                areas.append(torus_areas * corr_factor * count)
-            else:
-                hists += hist
-                areas += torus_areas * corr_factor * count
+    """
 
-        # If density, divide summed torus counts by summed areas
-        if density:
-            hists = np.array(hists) / np.array(areas)
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    counts = np.asarray(counts, dtype=float)
 
-        # Append subset result
-        subresult = pd.DataFrame({'x': radii})
-        if full:
-            for i in range(len(hists)):
-                subresult[i] = hists[i]
-        else:
-            subresult['y'] = hists
-        result_list.append((substring, subresult))
+    # Tree pairs each individual with itself at distance zero, remove these
+    if other_tree is None:
+        other_tree, other_counts = tree, counts
+        self_pairs = np.sum(counts)
+    else:
+        other_counts = np.asarray(other_counts, dtype=float)
+        self_pairs = 0
 
-    # Return all results
-    return result_list
+    # Pairs closer than each edge, or no farther than the final edge
+    # No pairs are closer than a negative distance
+    radii = np.append(np.nextafter(bin_edges[:-1], -np.inf), bin_edges[-1])
+    nonneg = radii >= 0
+    cum_pairs = np.zeros(len(radii))
+
+    if np.any(nonneg):
+        cum_pairs[nonneg] = (tree.count_neighbors(other_tree, radii[nonneg],
+                                                  weights=(counts,
+                                                           other_counts))
+                             - self_pairs)
+
+    return np.diff(cum_pairs)
+
+
+def _ring_counts_by_point(tree, counts, bin_edges):
+    """
+    Histogram of distances from the individuals at each point to all others
+
+    Parameters
+    ----------
+    tree : cKDTree
+        Tree of locations of points
+    counts : ndarray
+        Number of individuals at each point
+    bin_edges : iterable
+        List of edges of distance classes
+
+    Returns
+    -------
+    ndarray
+        Array with one row per point, giving the histogram of distances from
+        all individuals at that point to all other individuals
+
+    Notes
+    -----
+    Only pairs of points no farther apart than the final edge are found, and
+    memory scales with the number of these pairs rather than individuals.
+
+    """
+
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    counts = _wide_counts(counts)
+    n_points = len(counts)
+    n_bins = len(bin_edges) - 1
+
+    # Pairs of points within range, in both directions
+    pairs = np.array(list(tree.query_pairs(bin_edges[-1])), dtype=int)
+    pairs = pairs.reshape(-1, 2)
+    focal = np.concatenate((pairs[:, 0], pairs[:, 1]))
+    other = np.concatenate((pairs[:, 1], pairs[:, 0]))
+    dists = np.sqrt(np.sum((tree.data[focal] - tree.data[other])**2, axis=1))
+
+    # Individuals at other points, binned by distance for each focal point
+    bins = _hist_bins(dists, bin_edges)
+    keep = bins >= 0
+    hists = np.bincount(focal[keep] * n_bins + bins[keep],
+                        weights=counts[other[keep]],
+                        minlength=n_points * n_bins).reshape(n_points, n_bins)
+    hists = hists * counts[:, np.newaxis]
+
+    # Other individuals at the same point are at distance zero
+    zero_bin = _hist_bins(np.zeros(1), bin_edges)[0]
+    if zero_bin >= 0:
+        hists[:, zero_bin] += counts * (counts - 1)
+
+    if counts.dtype.kind in 'iub':
+        hists = hists.astype(np.int64)
+
+    return hists
+
+
+def _hist_bins(values, bin_edges):
+    """
+    Index of the np.histogram bin containing each value, or -1 if none
+    """
+
+    n_bins = len(bin_edges) - 1
+    bins = np.searchsorted(bin_edges, values, side='right') - 1
+    bins[values == bin_edges[-1]] = n_bins - 1  # Final bin includes its end
+    bins[(bins < 0) | (bins >= n_bins)] = -1
+
+    return bins
 
 
 def _get_plot_geometry(subpatch, bin_edges, x_col, y_col):
 
-    # Plot polygon
-    xmin = eval(subpatch.meta[x_col]['min'])
-    xmax = eval(subpatch.meta[x_col]['max'])
-    ymin = eval(subpatch.meta[y_col]['min'])
-    ymax = eval(subpatch.meta[y_col]['max'])
-    plot_poly = geo.box(xmin, ymin, xmax, ymax)
+    # Plot bounds, as for shapely box
+    xmin = subpatch.meta[x_col].min
+    xmax = subpatch.meta[x_col].max
+    ymin = subpatch.meta[y_col].min
+    ymax = subpatch.meta[y_col].max
+    plot_bounds = (xmin, ymin, xmax, ymax)
 
     # Radii of toruses
     bin_edges = np.array(bin_edges)
@@ -1035,7 +2854,73 @@ def _get_plot_geometry(subpatch, bin_edges, x_col, y_col):
     for i in range(len(bin_edges) - 1):
         torus_areas.append(np.pi * (bin_edges[i+1]**2 - bin_edges[i]**2))
 
-    return plot_poly, radii, np.array(torus_areas)
+    return plot_bounds, radii, np.array(torus_areas)
+
+
+def _edge_correction(points, radii, plot):
+    """
+    Fraction of the circumference of circles around points inside a plot
+
+    Parameters
+    ----------
+    points : ndarray
+        Array of shape (n points, 2) giving the center of each circle
+    radii : ndarray
+        Radius of each circle around every point
+    plot : tuple or shapely geometry
+        Bounds (xmin, ymin, xmax, ymax) of a rectangular plot, or a shapely
+        polygon of any shape
+
+    Returns
+    -------
+    ndarray
+        Array of shape (n points, n radii) of the fraction of each circle
+        inside the plot
+
+    Notes
+    -----
+    Rectangular plots are corrected analytically. The arc of a circle beyond
+    an edge at distance d from its center spans an angle of 2 arccos(d / r),
+    and the arcs beyond two adjacent edges overlap, by the amount their half
+    angles sum to more than pi / 2, only when the corner between them is
+    inside the circle. Other polygons fall back on the intersection of each
+    circle with the plot in shapely, which is much slower.
+
+    """
+
+    points = np.asarray(points, dtype=float)
+    radii = np.asarray(radii, dtype=float)
+
+    if not isinstance(plot, tuple):
+        corr_factors = np.ones((len(points), len(radii)))
+        for i, point in enumerate(points):
+            for j, r in enumerate(radii):
+                circ = geo.Point(*point).buffer(r, resolution=64)
+                outside_len = circ.boundary.difference(plot).length
+                corr_factors[i, j] = ((circ.boundary.length - outside_len) /
+                                      circ.boundary.length)
+        return corr_factors
+
+    xmin, ymin, xmax, ymax = plot
+    x = points[:, 0:1]
+    y = points[:, 1:2]
+    r = radii[np.newaxis, :]
+
+    # Half angle of arc beyond left, right, bottom, and top edges
+    with np.errstate(divide='ignore', invalid='ignore'):
+        half_angles = [np.arccos(np.clip(d / r, -1, 1)) for d in
+                       [x - xmin, xmax - x, y - ymin, ymax - y]]
+    left, right, bottom, top = half_angles
+
+    outside = 2 * np.sum(half_angles, axis=0)
+    for side in [left, right]:
+        for end in [bottom, top]:
+            outside -= np.maximum(side + end - np.pi / 2, 0)
+
+    corr_factors = np.clip(1 - outside / (2 * np.pi), 0, 1)
+    corr_factors[:, radii == 0] = 1  # Circle of radius zero is a point
+
+    return corr_factors
 
 
 
@@ -1148,18 +3033,14 @@ def _get_cols(special_col_names, cols, patch):
     Retrieve values of special_cols from cols string or patch metadata
     """
 
-    # If cols not given, try to fall back on cols from metadata
-    if not cols:
-        if 'cols' in patch.meta['Description'].keys():
-            cols = patch.meta['Description']['cols']
-        else:
-            raise NameError, ("cols argument not given, spp_col at a minimum "
-                              "must be specified")
-
-    # Parse cols string into dict
-    cols = cols.replace(' ', '')
-    col_list = cols.split(';')
-    col_dict = {x.split(':')[0]: x.split(':')[1] for x in col_list}
+    # If cols not given, try to fall back on cols parsed from metadata
+    if cols:
+        col_dict = _parse_cols(cols)
+    elif 'cols' in patch.meta['Description']:
+        col_dict = patch.meta.cols
+    else:
+        raise NameError, ("cols argument not given, spp_col at a minimum "
+                          "must be specified")
 
     # Get special_col_names from dict
     result = []
@@ -1169,7 +3050,7 @@ def _get_cols(special_col_names, cols, patch):
         # Create a count col if its requested and doesn't exist
         if special_col_name is 'count_col' and col_name is None:
             col_name = 'count'
-            patch.table['count'] = np.ones(len(patch.table))
+            patch._add_ones_col('count')
 
         # All special cols must be specified (count must exist by now)
         if col_name is None:
@@ -1196,7 +3077,8 @@ def _yield_subpatches(patch, splits, name='split'):
     Yields
     ------
     tuple
-        First element is subset string, second is subtable dataframe
+        First element is subset string, second is subpatch, a PatchView of
+        patch for a Patch
 
     Notes
     -----
@@ -1206,18 +3088,130 @@ def _yield_subpatches(patch, splits, name='split'):
 
     if splits:
         subset_list = _parse_splits(patch, splits)
-        for subset in subset_list:
+        indices = _split_indices(patch, splits)
+        for i, subset in enumerate(subset_list):
             logging.info('Analyzing subset %s: %s' % (name, subset))
-            subpatch = copy.copy(patch)
-            subpatch.table = _subset_table(patch.table, subset)
-            subpatch.meta, subpatch.incremented = _subset_meta(patch.meta,
-                                                subset, incremented=True)
-
-            yield subset, subpatch
+            index = None if indices is None else indices[i]
+            yield subset, patch._subset_patch(subset, index)
     else:
         yield '', patch
 
 
+def _split_indices(patch, splits):
+    """
+    Positions in table of the records of each subset string given by
+    _parse_splits, in the same order
+
+    Each record is given the position of its subset in one pass over each
+    split column, and the positions of records are sorted once by subset so
+    that each index is a slice of them. Records in no subset are dropped, as
+    they are by _subset_table, and records keep their order within each
+    subset. Only the split columns are read.
+
+    Returns None for a MappedPatch, whose subpatches instead subset each chunk
+    of records as it is read.
+    """
+
+    if isinstance(patch, MappedPatch):
+        return None
+
+    split_list = splits.replace(' ','').split(';')
+    table = patch._table_cols([split.split(':')[0] for split in split_list])
+
+    # Position of subset for each record, with last split varying fastest
+    keys = np.zeros(len(table), dtype=int)
+    n_subsets = 1
+    for split in split_list:
+        col, val = split.split(':')
+
+        if val == 'split':
+            codes, levels = pd.factorize(table[col])
+            n_levels = len(levels)
+        else:
+            starts, ends = _col_starts_ends(patch, col, val)
+            codes = _cell_index(table[col], starts, ends)
+            n_levels = len(starts)
+
+        keys = np.where((keys < 0) | (codes < 0), -1, keys * n_levels + codes)
+        n_subsets *= n_levels
+
+    order = np.argsort(keys, kind='mergesort')
+    bounds = np.searchsorted(keys[order], np.arange(n_subsets + 1))
+
+    return [order[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _map_subpatches(func, patch, splits, n_jobs=1, args=()):
+    """
+    Apply func to each subpatch defined by a splits string
+
+    Parameters
+    ----------
+    func : function
+        Module level function called as func(subpatch, *args), returning the
+        result dataframe for a subpatch
+    patch : obj
+        Patch object containing data to subset
+    splits : str
+        Specifies how a column of a dataset should be split
+    n_jobs : int
+        Number of processes, or None for one per processor. Default 1.
+    args : tuple
+        Further arguments to func
+
+    Returns
+    -------
+    list
+        List of tuples of subset string and result of func, in split order
+
+    Notes
+    -----
+    The patch is sent to each worker process once, when the pool starts, and
+    each task sends only its subset string. Workers split the table once and
+    build their own subpatches.
+
+    """
+
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+
+    if n_jobs == 1 or not splits:
+        return [(substring, func(subpatch, *args)) for substring, subpatch
+                in _yield_subpatches(patch, splits)]
+
+    subset_list = _parse_splits(patch, splits)
+    logging.info('Analyzing %d subsets in %d processes' %
+                 (len(subset_list), n_jobs))
+
+    pool = multiprocessing.Pool(n_jobs, _init_split_worker, (patch, splits))
+    try:
+        results = pool.map(_split_worker,
+                           [(func, i, subset, args) for i, subset
+                            in enumerate(subset_list)],
+                           chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return zip(subset_list, results)
+
+
+_worker_patch = None
+_worker_indices = None
+
+def _init_split_worker(patch, splits):
+    global _worker_patch, _worker_indices
+    _worker_patch = patch
+    _worker_indices = _split_indices(patch, splits)
+
+
+def _split_worker(task):
+    func, i, subset, args = task
+    index = None if _worker_indices is None else _worker_indices[i]
+    subpatch = _worker_patch._subset_patch(subset, index)
+    return func(subpatch, *args)
+
+
 @doc_sub(splits_note)
 def _parse_splits(patch, splits):
     """
@@ -1248,10 +3242,8 @@ def _parse_splits(patch, splits):
         col, val = split.split(':')
 
         if val == 'split':
-            uniques = []
-            for level in patch.table[col]:
-                if level not in uniques:
-                    uniques.append(level)
+            # Levels in order of appearance, as in _split_indices
+            uniques = patch._levels(col)
             level_list = [col + '==' + str(x) + '; ' for x in uniques]
         else:
             starts, ends = _col_starts_ends(patch, col, val)
@@ -1268,9 +3260,8 @@ def _patch_area(patch, x_col, y_col):
 
     lengths = []
     for col in [x_col, y_col]:
-        col_step = eval(patch.meta[col]['step'])
-        col_min = eval(patch.meta[col]['min'])
-        col_max = eval(patch.meta[col]['max'])
+        col_meta = patch.meta[col]
+        col_step, col_min, col_max = col_meta.step, col_meta.min, col_meta.max
 
         if patch.incremented:
             lengths.append(col_max - col_min)
@@ -1281,9 +3272,8 @@ def _patch_area(patch, x_col, y_col):
 
 def _col_starts_ends(patch, col, slices):
 
-    col_step = eval(patch.meta[col]['step'])
-    col_min = eval(patch.meta[col]['min'])
-    col_max = eval(patch.meta[col]['max'])
+    col_meta = patch.meta[col]
+    col_step, col_min, col_max = col_meta.step, col_meta.min, col_meta.max
 
     edges = np.linspace(col_min-col_step/2, col_max+col_step/2, eval(slices)+1)
 
@@ -1293,6 +3283,113 @@ def _col_starts_ends(patch, col, slices):
     return starts, ends
 
 
+def _div_split_list(div):
+    """
+    Split a single division, string or tuple, into x and y division strings
+    """
+
+    # Catch error if you don't use ; after divs in comm_grid in MacroecoDesktop
+    try:
+        div_split_list = div.replace(';','').split(',')
+    except AttributeError:
+        div_split_list = str(div).strip("()").split(',')
+
+    return [x.strip() for x in div_split_list]
+
+
+def _coarsen_cell_matrix(cell_matrix, fine_div, coarse_div):
+    """
+    Sum species by cell matrices from Patch._cell_matrix into a coarser grid
+
+    Parameters
+    ----------
+    cell_matrix : tuple
+        Species list, abundance and presence matrices for fine_div
+    fine_div, coarse_div : tuple
+        Number of x and y divisions of each grid. Divisions of the coarse grid
+        must evenly divide those of the fine grid.
+
+    Returns
+    -------
+    tuple
+        Species list, abundance and presence matrices for coarse_div
+
+    """
+
+    spp_list, abund, pres = cell_matrix
+    fine_x, fine_y = [eval(x) for x in fine_div]
+    coarse_x, coarse_y = [eval(x) for x in coarse_div]
+
+    # Coarse cell of each fine cell, with y varying fastest in both grids
+    fine_ix, fine_iy = np.divmod(np.arange(fine_x * fine_y), fine_y)
+    coarse_cells = ((fine_ix // (fine_x // coarse_x)) * coarse_y +
+                    fine_iy // (fine_y // coarse_y))
+
+    agg = sparse.coo_matrix((np.ones(len(coarse_cells), dtype=np.int64),
+                             (np.arange(len(coarse_cells)), coarse_cells)),
+                            shape=(fine_x * fine_y, coarse_x * coarse_y))
+    agg = agg.tocsc()
+
+    coarse_abund = abund.dot(agg).tocsr()
+    coarse_pres = pres.astype(np.int64).dot(agg).tocsr().astype(bool)
+
+    return spp_list, coarse_abund, coarse_pres
+
+
+def _cell_index(values, starts, ends):
+    """
+    Index of the cell, given by starts and ends, containing each value
+
+    Values in no cell are given an index of -1. Cells include their start and
+    exclude their end. Edges are rounded through str, as they are in the
+    subset strings created by _parse_splits, so that values on a boundary are
+    assigned exactly as _subset_table would assign them.
+    """
+
+    starts = np.array([float(str(x)) for x in starts])
+    ends = np.array([float(str(x)) for x in ends])
+    values = np.asarray(values, dtype=float)
+
+    idx = np.searchsorted(starts, values, side='right') - 1
+    in_cell = (idx >= 0) & (values < ends[np.maximum(idx, 0)])
+
+    return np.where(in_cell, idx, -1)
+
+
+def _spp_codes(spp, spp_list):
+    """
+    Integer code of each record in spp giving its position in spp_list
+
+    spp_list must contain every value in spp. Codes are found by hashing,
+    which is much faster than a binary search for strings.
+    """
+    return pd.Index(spp_list).get_indexer(np.asarray(spp))
+
+
+def _wide_counts(counts):
+    """
+    Counts as int64 or float64, so that sums of compact counts do not overflow
+    """
+    counts = np.asarray(counts)
+    return counts.astype(np.int64 if counts.dtype.kind in 'iub' else float)
+
+
+def _spp_abundances(spp, counts, spp_list):
+    """
+    Total of counts for each species in spp_list, in a single bincount pass
+    """
+
+    counts = np.asarray(counts)
+    abunds = np.bincount(_spp_codes(spp, spp_list), weights=counts,
+                         minlength=len(spp_list))
+
+    # bincount always returns floats, restore integer counts if given
+    if counts.dtype.kind in 'iub':
+        abunds = abunds.astype(np.int64)
+
+    return abunds
+
+
 def _product(*args, **kwds):
     """
     Generates cartesian product of lists given as arguments
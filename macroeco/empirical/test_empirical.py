@@ -1,5 +1,7 @@
 from __future__ import division
 import os
+import shutil
+import tempfile
 from configparser import ConfigParser
 
 import unittest
@@ -13,6 +15,7 @@ import macroeco.empirical._empirical as _emp
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
+import scipy.spatial.distance as dist
 
 # Check whether shapely is installed
 try:
@@ -21,6 +24,13 @@ try:
 except:
     shapely_missing = True
 
+# Check whether numexpr is installed
+try:
+    import numexpr
+    numexpr_missing = False
+except:
+    numexpr_missing = True
+
 class Patches(TestCase):
 
     def setUp(self):
@@ -72,6 +82,361 @@ class TestPatch(Patches):
         assert_equal(pat1.table['count'].iloc[0], 3)
         assert_equal(len(pat1.table), 1)
 
+    def test_load_through_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            meta_path = os.path.join(tmp_dir, 'test_meta1.txt')
+            table_path = os.path.join(tmp_dir, 'test_table1.csv')
+            shutil.copy(self.meta1_path, meta_path)
+            shutil.copy(self.table1_path, table_path)
+
+            # First load writes cache, second reads it
+            pat1 = emp.Patch(meta_path, cache=True)
+            assert_(os.path.isfile(os.path.join(table_path + '.cache',
+                                                'manifest.json')))
+            pat2 = emp.Patch(meta_path, "spp=='b'", cache=True)
+            assert_frame_equal(pat1.table, self.table1)
+            assert_frame_equal(pat2.table,
+                               self.table1[self.table1['spp'] == 'b'])
+
+            # Changed data file is read again
+            with open(table_path, 'a') as f:
+                f.write('\rc,0.2,0.1,5,2010')
+            pat3 = emp.Patch(meta_path, cache=True)
+            assert_equal(len(pat3.table), len(self.table1) + 1)
+            assert_equal(pat3.table['spp'].iloc[-1], 'c')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_load_in_chunks(self):
+        subset = "spp=='a' or count>2"
+        pat1 = emp.Patch(self.meta1_path, subset, chunk_size=2)
+        assert_frame_equal(pat1.table, _emp._subset_table(self.table1, subset))
+
+    def test_load_needed_cols(self):
+        pat1 = emp.Patch(self.meta1_path, "year==2010", cols='spp_col:spp',
+                         splits='x:2', chunk_size=2)
+        assert_equal(list(pat1.table.columns), ['spp', 'x'])
+        assert_array_equal(pat1.table.index, [2, 3, 4])
+
+        # Metrics add missing count col
+        sad = emp.sad(pat1, 'spp_col:spp', 'x:2')
+        assert_array_equal(sad[0][1]['y'], [1, 1])
+
+    def test_compact_table(self):
+        pat1 = emp.Patch(self.meta1_path, compact=True)
+        assert_equal(str(pat1.table['spp'].dtype), 'category')
+        assert_equal(pat1.table['count'].dtype, np.int8)
+        assert_equal(pat1.table['year'].dtype, np.int16)
+        assert_equal(pat1.table['x'].dtype, np.float64)  # 0.1 not float32
+        assert_array_equal(pat1.table, self.table1)
+
+        table = _emp._compact_table(pd.DataFrame({'x': [0.5, 1.5],
+                                                  'y': [1., 2.]}), ['x', 'y'])
+        assert_equal(table['x'].dtype, np.float32)
+        assert_equal(table['y'].dtype, np.float32)
+
+    def test_compact_metrics_match(self):
+        pat1 = emp.Patch(self.meta1_path, compact=True)
+        for res1, res2 in [
+                (emp.sad(pat1, self.cols1, 'year:split; x:2', clean=False),
+                 emp.sad(self.pat1, self.cols1, 'year:split; x:2',
+                         clean=False)),
+                (emp.sar(pat1, self.cols1, '', '1,1; 2,3'),
+                 emp.sar(self.pat1, self.cols1, '', '1,1; 2,3')),
+                (emp.o_ring(pat1, self.cols1, '', None, [0, .1, .2]),
+                 emp.o_ring(self.pat1, self.cols1, '', None, [0, .1, .2]))]:
+            assert_equal([x[0] for x in res1], [x[0] for x in res2])
+            for (_, df1), (_, df2) in zip(res1, res2):
+                assert_frame_equal(df1, df2)
+
+    def test_from_dataframe(self):
+        meta = {'x': {'min': 0.1, 'max': 0.2, 'step': 0.1},
+                'y': {'min': '0.1', 'max': '0.3', 'step': '0.1'}}
+        pat1 = emp.Patch.from_dataframe(self.table1, meta)
+        assert_(pat1.table is self.table1)
+        assert_equal(pat1.meta['x'], dict(self.meta1['x']))
+        assert_equal(pat1.meta['y'], dict(self.meta1['y']))
+
+        pat1 = emp.Patch.from_dataframe(self.table1, meta, 'x>=0.2')
+        assert_array_equal(pat1.table, self.table1[self.table1.x >= 0.2])
+        assert_equal(pat1.meta['x']['min'], '0.2')
+
+        class SubPatch(emp.Patch):
+            pass
+        assert_(isinstance(SubPatch.from_dataframe(self.table1, meta),
+                           SubPatch))
+
+        sar = emp.sar(emp.Patch.from_dataframe(self.table1, meta), self.cols1,
+                      'year:split', '1,1; 2,3')
+        csv_sar = emp.sar(self.pat1, self.cols1, 'year:split', '1,1; 2,3')
+        for (name, df), (csv_name, csv_df) in zip(sar, csv_sar):
+            assert_equal(name, csv_name)
+            assert_frame_equal(df, csv_df)
+
+    def test_from_arrays(self):
+        arrays = dict((col, self.table1[col].values.copy())
+                      for col in self.table1.columns)
+        pat1 = emp.Patch.from_arrays(arrays, {},
+                                     columns=list(self.table1.columns))
+        assert_array_equal(pat1.table, self.table1)
+
+        # Arrays are shared unless pandas consolidates them into new blocks
+        probe = np.arange(3.)
+        probe_frame = pd.DataFrame({'a': probe}, copy=False)
+        if np.may_share_memory(probe_frame['a'].values, probe):
+            for col in self.table1.columns:
+                assert_(np.may_share_memory(pat1.table[col].values,
+                                            arrays[col]))
+
+        assert_raises(ValueError, emp.Patch.from_arrays,
+                      {'x': [1, 2], 'y': [1]})
+
+    def test_meta_parsed_once(self):
+        assert_equal(self.pat1.meta['x'].step, 0.1)
+        assert_equal(self.pat1.meta['y'].max, 0.3)
+        assert_equal(self.pat1.meta.cols, {'spp_col': 'spp'})
+        assert_raises(TypeError, self.pat1.meta['x'].__setitem__, 'min', '0')
+
+        # Subpatch shares sections it does not change
+        subpatch = self.pat1._subset_patch('x>=0.2; y<0.3')
+        assert_equal(subpatch.meta['x'].min, 0.2)
+        assert_equal(subpatch.meta['y'].max, 0.3)
+        assert_(subpatch.meta['Description'] is self.pat1.meta['Description'])
+        assert_equal(self.pat1.meta['x'].min, 0.1)
+
+    def test_meta_assigned_as_dict(self):
+        pat1 = emp.Patch(None)
+        pat1.table = self.table1
+        pat1.meta = {'x': {'min': 0.1, 'max': 0.2, 'step': 0.1},
+                     'y': {'min': 0.1, 'max': 0.3, 'step': 0.1}}
+        assert_equal(pat1.meta['y'].max, 0.3)
+        assert_array_equal(emp.sar(pat1, self.cols1, None, '1,1')[0][1],
+                           emp.sar(self.pat1, self.cols1, None, '1,1')[0][1])
+
+        assert_raises(ValueError, setattr, pat1, 'meta',
+                      {'x': {'min': '1/10', 'max': 0.2, 'step': 0.1}})
+
+    def test_subset_or(self):
+        pat1 = emp.Patch(self.meta1_path, "spp=='a' or count>2")
+        assert_array_equal(pat1.table.index, [0, 1, 2, 4])
+        assert_equal(pat1.meta, self.meta1)  # Meta should not change
+
+    def test_subset_in(self):
+        pat1 = emp.Patch(self.meta1_path, "year in (2000, 2005); x<0.2")
+        assert_array_equal(pat1.table.index, [0, 1])
+
+        pat1 = emp.Patch(self.meta1_path, "spp not in ['a']")
+        assert_array_equal(pat1.table.index, [3, 4])
+
+    def test_subset_grouped(self):
+        pat1 = emp.Patch(self.meta1_path,
+                         "(spp=='b' and y>0.2) or (spp==a; year==2000)")
+        assert_array_equal(pat1.table.index, [0, 1, 4])
+
+    def test_subset_column_names_not_identifiers(self):
+        table = pd.DataFrame({'x.1': [1, 2, 3], 'dbh-2': [4, 5, 6],
+                              '2010': [7, 8, 9]})
+        sub = _emp._subset_table(table, "x.1>=2; dbh-2<6")
+        assert_array_equal(sub.index, [1])
+        sub = _emp._subset_table(table, "2010 in (7, 9)")
+        assert_array_equal(sub.index, [0, 2])
+
+    def test_subset_numexpr_numbers(self):
+        assert_equal(_emp._numexpr_number(long(2)**70), str(2**70))
+        assert_equal(float(_emp._numexpr_number(0.1 + 0.2)), 0.1 + 0.2)
+
+    def test_subset_compiled_once(self):
+        subset = "spp=='a'; y<0.2"
+        assert_(_emp._compile_subset(subset) is _emp._compile_subset(subset))
+
+    @unittest.skipIf(numexpr_missing, "numexpr not present, skipping test")
+    def test_subset_numexpr_matches_numpy(self):
+        pred = _emp._compile_subset("x>=0.1; y<0.3 or count in (3, 4)")
+        local_dict = dict(('c%d' % i, np.asarray(self.table1[col]))
+                          for i, col in enumerate(pred._cols))
+        assert_array_equal(numexpr.evaluate(pred._numexpr_str, local_dict),
+                           pred._evaluate(pred.tree, self.table1))
+
+    def test_subset_not_valid_raises_error(self):
+        assert_raises(ValueError, _emp._subset_table, self.table1, "x>")
+        assert_raises(ValueError, _emp._subset_table, self.table1, "x>1 y<2")
+        assert_raises(KeyError, _emp._subset_table, self.table1, "z>1")
+
+    def test_cell_matrix(self):
+        spp, abund, pres = self.pat1._cell_matrix('2,1', 'spp', 'count',
+                                                  'x', 'y')
+        assert_array_equal(spp, ['a', 'b'])
+        assert_array_equal(abund.toarray(), [[4, 0], [1, 3]])
+        assert_array_equal(pres.toarray(), [[True, False], [True, True]])
+
+    def test_cell_matrix_nested_equals_direct(self):
+        # Direct matrix from a fresh patch, nested one summed from '2,3'
+        fresh_pat1 = emp.Patch(self.meta1_path)
+        _, direct_abund, direct_pres = fresh_pat1._cell_matrix(
+            '1,3', 'spp', 'count', 'x', 'y')
+        self.pat1._cell_matrix('2,3', 'spp', 'count', 'x', 'y')
+        _, abund, pres = self.pat1._cell_matrix('1,3', 'spp', 'count',
+                                                'x', 'y')
+        assert_array_equal(abund.toarray(), direct_abund.toarray())
+        assert_array_equal(pres.toarray(), direct_pres.toarray())
+
+    def test_cell_matrix_reset_with_table(self):
+        self.pat1._cell_matrix('2,1', 'spp', 'count', 'x', 'y')
+        self.pat1.table = self.pat1.table[3:]  # Leave only 'b'
+        spp, abund, _ = self.pat1._cell_matrix('2,1', 'spp', 'count',
+                                               'x', 'y')
+        assert_array_equal(spp, ['b'])
+        assert_array_equal(abund.toarray(), [[1, 3]])
+
+
+class TestMappedPatch(Patches):
+
+    def setUp(self):
+        super(TestMappedPatch, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.tmp_meta1_path = os.path.join(self.tmp_dir, 'test_meta1.txt')
+        shutil.copy(self.meta1_path, self.tmp_meta1_path)
+        shutil.copy(self.table1_path, self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assert_results_equal(self, res1, res2):
+        assert_equal([x[0] for x in res1], [x[0] for x in res2])
+        for (_, df1), (_, df2) in zip(res1, res2):
+            assert_frame_equal(df1, df2)
+
+    def test_table_in_chunks(self):
+        mpat1 = emp.MappedPatch(self.tmp_meta1_path, "y<0.3", chunk_size=2)
+        pat1 = emp.Patch(self.meta1_path, "y<0.3")
+        assert_frame_equal(mpat1.table, pat1.table)
+        assert_equal(mpat1.meta, pat1.meta)
+        assert_equal([len(x) for x in mpat1.iter_chunks()], [2, 1, 0])
+
+    def test_metrics_match_patch(self):
+        mpat1 = emp.MappedPatch(self.tmp_meta1_path, chunk_size=2)
+        self.assert_results_equal(
+            emp.sad(mpat1, self.cols1, 'year:split; x:2', clean=False),
+            emp.sad(self.pat1, self.cols1, 'year:split; x:2', clean=False))
+        self.assert_results_equal(
+            emp.sar(mpat1, self.cols1, 'year:split', '1,1; 2,1; 2,3'),
+            emp.sar(self.pat1, self.cols1, 'year:split', '1,1; 2,1; 2,3'))
+        self.assert_results_equal(
+            emp.comm_grid(mpat1, self.cols1, '', '2,3'),
+            emp.comm_grid(self.pat1, self.cols1, '', '2,3'))
+        self.assert_results_equal(
+            emp.o_ring(mpat1, self.cols1, 'y:2', 'a', [0, .1, .2]),
+            emp.o_ring(self.pat1, self.cols1, 'y:2', 'a', [0, .1, .2]))
+
+    def test_table_cannot_be_set(self):
+        mpat1 = emp.MappedPatch(self.tmp_meta1_path, chunk_size=2)
+        assert_raises(TypeError, setattr, mpat1, 'table', self.table1)
+        assert_raises(TypeError, emp.MappedPatch.from_dataframe, self.table1)
+
+    def test_stale_cache_not_hashed(self):
+        emp.MappedPatch(self.tmp_meta1_path, chunk_size=2)
+        with open(os.path.join(self.tmp_dir, 'test_table1.csv'), 'a') as f:
+            f.write('\rc,0.2,0.1,5,2010')
+
+        # Size shows the cache is stale, so only the rewrite hashes the csv
+        hashed = []
+        file_md5 = _emp._file_md5
+        _emp._file_md5 = lambda path: hashed.append(path) or file_md5(path)
+        try:
+            mpat1 = emp.MappedPatch(self.tmp_meta1_path, chunk_size=2)
+        finally:
+            _emp._file_md5 = file_md5
+        assert_equal(len(hashed), 1)
+        assert_equal(mpat1._n_rows, len(self.table1) + 1)
+
+    def test_missing_count_col_is_ones(self):
+        mpat1 = emp.MappedPatch(self.tmp_meta1_path, chunk_size=2)
+        sad = emp.sad(mpat1, 'spp_col:spp', None)
+        assert_array_equal(sad[0][1]['y'], [3, 2])
+
+
+class TestDbPatch(Patches):
+
+    def setUp(self):
+        super(TestDbPatch, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+
+        # Same table as test_table1.csv, as a db and as a sql script
+        table = self.table1
+        sql = ['CREATE TABLE census (spp TEXT, x REAL, y REAL, '
+               'count INTEGER, year INTEGER);']
+        for row in table.itertuples(index=False):
+            sql.append("INSERT INTO census VALUES ('%s', %r, %r, %d, %d);" %
+                       tuple(row))
+        self.sql_path = os.path.join(self.tmp_dir, 'test_table1.sql')
+        with open(self.sql_path, 'w') as f:
+            f.write('\n'.join(sql))
+
+        con = _emp.sqlite3.connect(os.path.join(self.tmp_dir,
+                                                'test_table1.db'))
+        con.executescript('\n'.join(sql))
+        con.close()
+
+        self.tmp_meta_paths = {}
+        for extension in ['db', 'sql']:
+            meta = ConfigParser()
+            meta.read(self.meta1_path)
+            meta['Description']['datapath'] = 'test_table1.' + extension
+            path = os.path.join(self.tmp_dir, 'test_meta1_%s.txt' % extension)
+            with open(path, 'w') as f:
+                meta.write(f)
+            self.tmp_meta_paths[extension] = path
+
+    def tearDown(self):
+        _emp._close_db_connections()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_subset_pushed_down_matches_csv(self):
+        for extension in ['db', 'sql']:
+            meta_path = self.tmp_meta_paths[extension]
+            for subset in ['', "spp=='b'", "x>=0.2; y<0.3",
+                           "spp in ('a', 'c') or count>2"]:
+                pat1 = emp.Patch(meta_path, subset)
+                csv_pat1 = emp.Patch(self.meta1_path, subset)
+                assert_array_equal(pat1.table, csv_pat1.table)
+                assert_equal(list(pat1.table.columns),
+                             list(csv_pat1.table.columns))
+                assert_equal(pat1.meta['y'], csv_pat1.meta['y'])
+                assert_equal(pat1.meta['x'], csv_pat1.meta['x'])
+
+    def test_sql_query(self):
+        pat1 = emp.Patch(self.tmp_meta_paths['db'],
+                         "SELECT spp, count FROM census WHERE x > 0.15")
+        assert_array_equal(pat1.table,
+                           self.table1[self.table1.x > 0.15][['spp', 'count']])
+
+    def test_empty_query(self):
+        pat1 = emp.Patch(self.tmp_meta_paths['db'], "spp=='z'")
+        assert_equal(len(pat1.table), 0)
+        assert_equal(list(pat1.table.columns), list(self.table1.columns))
+
+    def test_connection_reused(self):
+        db_path = os.path.join(self.tmp_dir, 'test_table1.db')
+        assert_(_emp._db_connection(db_path, 'db') is
+                _emp._db_connection(db_path, 'db'))
+        assert_(_emp._db_connection(self.sql_path, 'sql') is
+                _emp._db_connection(self.sql_path, 'sql'))
+
+        con = _emp._db_connection(db_path, 'db')
+        _emp._close_db_connections()
+        assert_raises(_emp.sqlite3.ProgrammingError, con.execute,
+                      'SELECT 1')
+        assert_(_emp._db_connection(db_path, 'db') is not con)
+
+    def test_metrics_match_csv(self):
+        pat1 = emp.Patch(self.tmp_meta_paths['db'])
+        sad = emp.sad(pat1, self.cols1, 'year:split')
+        csv_sad = emp.sad(self.pat1, self.cols1, 'year:split')
+        for (name, df), (csv_name, csv_df) in zip(sad, csv_sad):
+            assert_equal(name, csv_name)
+            assert_frame_equal(df, csv_df)
+
 
 class TestSAD(Patches):
 
@@ -129,6 +494,13 @@ class TestSAD(Patches):
         sad = emp.sad(self.pat2, self.cols2, splits="mean:2; y:3", clean=True)
         assert_equal(len(sad[1][1]), 2)
 
+    def test_n_jobs_matches_one_process(self):
+        serial = emp.sad(self.pat1, self.cols1, 'year:split; x:2')
+        parallel = emp.sad(self.pat1, self.cols1, 'year:split; x:2', n_jobs=2)
+        assert_equal([x[0] for x in parallel], [x[0] for x in serial])
+        for (_, par_df), (_, ser_df) in zip(parallel, serial):
+            assert_frame_equal(par_df, ser_df)
+
 
 class TestSSAD(Patches):
 
@@ -164,6 +536,15 @@ class TestSAR(Patches):
         assert_array_almost_equal(sar[0][1]['x'], [0.5*self.A1])
         assert_array_equal(sar[0][1]['y'], [1.5])
 
+    def test_n_jobs_matches_one_process(self):
+        serial = emp.sar(self.pat1, self.cols1, 'year:split', '2,1; 1,3',
+                         ear=True)
+        parallel = emp.sar(self.pat1, self.cols1, 'year:split', '2,1; 1,3',
+                           ear=True, n_jobs=2)
+        assert_equal([x[0] for x in parallel], [x[0] for x in serial])
+        for (_, par_df), (_, ser_df) in zip(parallel, serial):
+            assert_frame_equal(par_df, ser_df)
+
     def test_empty_equals_split_subset(self):
         sar_empty = emp.sar(self.pat1, self.cols1, "", '1,1')
         sar_split = emp.sar(self.pat1, self.cols1, "x:1; y:1", '1,1')
@@ -184,6 +565,21 @@ class TestEAR(Patches):
         assert_array_equal(sar[0][1]['y'], [0.5, 0])
         assert_array_equal(sar[1][1]['y'], [0.5, 1/3.])
 
+    def test_hand_counted_endemics(self):
+        # Cells run from min - step/2 to max + step/2, so y edges are 0.05,
+        # 0.2 and 0.35 for 2 divisions and 0.05, 0.15, 0.25 and 0.35 for 3.
+        # In 2010, a is at (0.1, 0.3) and b at (0.1, 0.2) and (0.2, 0.3).
+        # Split 1,2: all records are in the upper cell, so both are endemic.
+        # Split 2,3: each record is in its own cell, so only a is endemic.
+        # Split 2,1: a and b share the left cell, b is also in the right.
+        sar = emp.sar(self.pat1, self.cols1, 'year:split', '1,2; 2,3; 2,1',
+                      ear=True)
+        assert_array_almost_equal(sar[1][1]['y'], [1., 1/6., 1/2.])
+
+        # In 2000, a is at (0.1, 0.1) and (0.1, 0.2), which are in different
+        # cells for splits 1,2 and 2,3 and in the same cell for split 2,1
+        assert_array_almost_equal(sar[0][1]['y'], [0, 0, 1/2.])
+
 
 class TestCommGrid(Patches):
 
@@ -228,8 +624,47 @@ class TestCommGrid(Patches):
         comm = emp.comm_grid(self.pat1, self.cols1, '', '2,2',metric='Jaccard')
         assert_array_equal(comm[0][1]['y'], [1/2., 0, 0, 0, 1/2., 0])
 
+    def test_xy_output(self):
+        comm = emp.comm_grid(self.pat1, self.cols1, '', '1,3', output='xy')
+        assert_array_almost_equal(comm[0][1]['x1'], [0.15, 0.15, 0.15])
+        assert_array_almost_equal(comm[0][1]['y1'], [0.1, 0.1, 0.2])
+        assert_array_almost_equal(comm[0][1]['x2'], [0.15, 0.15, 0.15])
+        assert_array_almost_equal(comm[0][1]['y2'], [0.2, 0.3, 0.3])
+        assert_array_equal(comm[0][1]['y'], [2/3., 2/3., 1.])
+
+    def test_dist_class_output(self):
+        comm = emp.comm_grid(self.pat1, self.cols1, '', '2,2',
+                             output='dist_class', bin_edges=[0, 0.12, 0.2])
+        assert_array_almost_equal(comm[0][1]['x'], [0.06, 0.16])
+        assert_array_equal(comm[0][1]['n'], [2, 4])
+        assert_array_almost_equal(comm[0][1]['y'], [1/3., 1/6.])
+        assert_array_almost_equal(comm[0][1]['var'], [1/9., 1/12.])
+
+    def test_dist_class_output_blocks(self):
+        pairs = emp.comm_grid(self.pat1, self.cols1, '', '2,3')[0][1]
+        _, _, pres = self.pat1._cell_matrix('2,3', 'spp', 'count', 'x', 'y')
+        loc = np.array(_emp._product([0.1, 0.2], [0.1, 0.2, 0.3]))
+        classes = _emp._dist_class_summary(
+            _emp._yield_cell_pairs(pres, loc, 'Sorensen', 1), [0, 0.15, 0.3])
+        near = pairs['y'][(pairs['x'] < 0.15) & pairs['y'].notnull()]
+        assert_equal(classes['n'][0], len(near))
+        assert_almost_equal(classes['y'][0], np.mean(near))
+        assert_almost_equal(classes['var'][0], np.var(near))
+
+    def test_cell_pair_blocks_equal_single_block(self):
+        _, _, pres = self.pat1._cell_matrix('2,3', 'spp', 'count', 'x', 'y')
+        loc = np.array(_emp._product([0.1, 0.2], [0.1, 0.2, 0.3]))
+        single = zip(*_emp._yield_cell_pairs(pres, loc, 'Jaccard'))
+        blocks = zip(*_emp._yield_cell_pairs(pres, loc, 'Jaccard', 4))
+        for single_col, blocks_col in zip(single, blocks):
+            assert_array_equal(np.concatenate(single_col),
+                               np.concatenate(blocks_col))
+
+    def test_bad_metric_raises_error(self):
+        assert_raises(ValueError, emp.comm_grid, self.pat1, self.cols1, '',
+                      '2,1', metric='Bray')
+
 
-@unittest.skipIf(shapely_missing, "shapely not present, skipping O-ring test")
 class TestORing(Patches):
     # TODO: Main may fail with error if dataframe has no records when trying to
     # fit or make plot.
@@ -269,6 +704,15 @@ class TestORing(Patches):
         assert_array_equal(o_ring[0][1]['y'], [])  # Bottom
         assert_array_equal(o_ring[1][1]['y'], [6, 6])  # Top
 
+    def test_full_sums_to_total(self):
+        edges = [0, .101, .201, .301]
+        total = emp.o_ring(self.pat1, self.cols1, '', 'a', edges,
+                           density=False)
+        full = emp.o_ring(self.pat1, self.cols1, '', 'a', edges,
+                          density=False, full=True)
+        assert_array_equal(full[0][1].drop('x', axis=1).sum(axis=1),
+                           total[0][1]['y'])
+
     def test_density_a(self):
         # First radius is 0.05
         o_ring = emp.o_ring(self.pat1, self.cols1, '', 'a', [0,.10000001])
@@ -284,6 +728,112 @@ class TestORing(Patches):
                                    6 / (3/8 * np.pi*(0.1828427**2 - 0.1**2))],
                                   3)
 
+    def test_all_spp_matches_single_spp(self):
+        edges = [0, .101, .201, .301]
+        batch = emp.o_ring(self.pat1, self.cols1, 'y:2', None, edges)
+        for (substring, res), (_, res_a), (_, res_b) in zip(batch,
+                emp.o_ring(self.pat1, self.cols1, 'y:2', 'a', edges),
+                emp.o_ring(self.pat1, self.cols1, 'y:2', 'b', edges)):
+            for spp, single in [('a', res_a), ('b', res_b)]:
+                rows = res[res['focal'] == spp]
+                assert_array_equal(rows['target'], [spp] * len(single))
+                assert_array_almost_equal(rows['y'], single['y'])
+
+    def test_bivariate_counts(self):
+        edges = [0, .101, .201, .301]
+        o_ring = emp.o_ring(self.pat1, self.cols1, '', [], edges,
+                            density=False, pairs=[('a', 'b'), ('a', 'x')])
+        res = o_ring[0][1]
+        assert_array_equal(res.columns, ['focal', 'target', 'x', 'y'])
+
+        table = self.pat1.table
+        a, b = table[table['spp'] == 'a'], table[table['spp'] == 'b']
+        dists = dist.cdist(a[['x', 'y']], b[['x', 'y']])
+        weights = np.outer(a['count'], b['count'])
+        expected = np.histogram(dists, edges, weights=weights)[0]
+        assert_array_almost_equal(res[res['target'] == 'b']['y'], expected)
+        assert_array_equal(res[res['target'] == 'x']['y'], [0, 0, 0])
+
+    def test_n_jobs_matches_one_process(self):
+        serial = emp.o_ring(self.pat1, self.cols1, 'y:2', None, [0, .1, .2])
+        parallel = emp.o_ring(self.pat1, self.cols1, 'y:2', None, [0, .1, .2],
+                              n_jobs=2)
+        assert_equal([x[0] for x in parallel], [x[0] for x in serial])
+        for (_, par_df), (_, ser_df) in zip(parallel, serial):
+            assert_frame_equal(par_df, ser_df)
+
+    def test_full_with_many_spp_raises_error(self):
+        assert_raises(ValueError, emp.o_ring, self.pat1, self.cols1, '',
+                      ['a', 'b'], [0, .1, .2], full=True)
+
+    def test_edge_correction_rectangle(self):
+        # Half circle at edge and quarter circle at corner. With corner inside
+        # circle, arcs of 2pi/3 beyond each edge overlap by pi/6.
+        points = [[0, 5], [0, 0], [1, 1], [5, 5]]
+        corr = _emp._edge_correction(points, [2], (0, 0, 10, 10))
+        assert_array_almost_equal(corr[:, 0], [0.5, 0.25, 5/12., 1])
+
+    @unittest.skipIf(shapely_missing, "shapely not present, skipping test")
+    def test_edge_correction_shapely_matches_rectangle(self):
+        points = [[0.1, 0.1], [0.15, 0.2], [0.2, 0.3]]
+        radii = [0.05, 0.15, 0.25]
+        rect = _emp._edge_correction(points, radii, (0.1, 0.1, 0.2, 0.3))
+        poly = _emp._edge_correction(points, radii,
+                                     geo.box(0.1, 0.1, 0.2, 0.3))
+        assert_array_almost_equal(rect, poly, 2)
+
+
+class TestSplitIndices(Patches):
+
+    def test_split_indices_match_subset_tables(self):
+        splits = 'year:split; x:2; y:3'
+        subsets = _emp._parse_splits(self.pat1, splits)
+        indices = _emp._split_indices(self.pat1, splits)
+        assert_equal(len(indices), len(subsets))
+        for subset, index in zip(subsets, indices):
+            assert_frame_equal(self.pat1.table.iloc[index],
+                               _emp._subset_table(self.pat1.table, subset))
+
+
+class TestPatchView(Patches):
+
+    def test_subpatch_is_view(self):
+        subpatch = self.pat1._subset_patch("spp=='a'")
+        assert_(isinstance(subpatch, emp.PatchView))
+        assert_(subpatch.parent is self.pat1)
+        assert_array_equal(subpatch.index, [0, 1, 2])
+        assert_frame_equal(subpatch.table,
+                           self.table1[self.table1['spp'] == 'a'])
+
+    def test_chunks_hold_only_needed_cols(self):
+        subpatch = self.pat1._subset_patch("year==2010")
+        chunk, = list(subpatch.iter_chunks(['spp', 'count']))
+        assert_equal(list(chunk.columns), ['spp', 'count'])
+        assert_array_equal(chunk.index, [2, 3, 4])
+        assert_(subpatch._table is None)
+
+    def test_view_of_view_shares_parent(self):
+        view = emp.PatchView(self.pat1, slice(1, 5))
+        subview = view._subset_patch("y>0.2")
+        assert_(subview.parent is self.pat1)
+        assert_array_equal(subview.index, [2, 4])
+        assert_frame_equal(subview.table, self.table1.iloc[[2, 4]])
+
+    def test_view_metrics_match_table(self):
+        view = emp.PatchView(self.pat1, np.array([0, 2, 3, 4]))
+        pat1 = emp.Patch.from_dataframe(self.table1.iloc[[0, 2, 3, 4]],
+                                        dict(self.meta1.items()))
+        for res1, res2 in [
+                (emp.sad(view, self.cols1, 'x:2', clean=False),
+                 emp.sad(pat1, self.cols1, 'x:2', clean=False)),
+                (emp.sar(view, 'spp_col:spp; x_col:x; y_col:y', 'year:split',
+                         '1,1; 2,3'),
+                 emp.sar(pat1, 'spp_col:spp; x_col:x; y_col:y', 'year:split',
+                         '1,1; 2,3'))]:
+            assert_equal([x[0] for x in res1], [x[0] for x in res2])
+            for (_, df1), (_, df2) in zip(res1, res2):
+                assert_frame_equal(df1, df2)
+
 
 class TestProduct():
 
@@ -259,9 +259,16 @@ def _emp_extra_options(options):
                         metadata_path)
     options['metadata_path'] = metadata_path
 
-    # Using subset if given, create and store patch
+    # Using subset if given, create and store patch, reading through a binary
+    # table cache if cache option is True, keeping only the columns used by
+    # cols and splits, and compacting the table if compact option is True
     subset = options.get('subset', '')
-    options['patch'] = emp.Patch(metadata_path, subset)
+    cache = _option_bool(options.get('cache', 'False'))
+    compact = _option_bool(options.get('compact', 'False'))
+    options['patch'] = emp.Patch(metadata_path, subset, cache,
+                                 options.get('cols', ''),
+                                 options.get('splits', ''),
+                                 compact=compact)
 
     # If cols or splits not given in options, make empty strings
     if 'cols' not in options.keys():
@@ -272,6 +279,19 @@ def _emp_extra_options(options):
     return options
 
 
+def _option_bool(value):
+    """
+    Boolean value of a True or False option string from the parameter file
+    """
+
+    value = value.strip().lower()
+    if value in ('true', '1', 'yes'):
+        return True
+    if value in ('false', '0', 'no', ''):
+        return False
+    raise ValueError, "Value %s is not True or False" % value
+
+
 def _arg_kwarg_lists(module, analysis):
 
     # Get names of args and kwargs to method specified by analysis option
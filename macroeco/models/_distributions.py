@@ -2,6 +2,7 @@ from __future__ import division
 import sys
 
 from decimal import Decimal
+from collections import OrderedDict
 import numpy as np
 import numpy.random as nprand
 from scipy.stats.distributions import (rv_discrete, rv_continuous)
@@ -82,7 +83,8 @@ l : int
     Lower bound of distribution (Either 0 or 1).  Default is 1
 b : int
     Upper bound of distribution for computational purposes, even if
-    distribution technically has infinite support. Default is 1e5.
+    distribution technically has infinite support. Draws are not above b.
+    Default is 1e5.
 size : int
     Number of random variables to draw.  Default is 1.
 
@@ -143,14 +145,9 @@ _doc_make_rank = \
 """
 obj : discrete distribution object
     Scipy discrete distribution object
-crit : float
-    A probability between 0 - 1.  Below this value ppf is used, above a this
-    value a solver is used.
 upper : int
-    Upper bound to the solver.  Rank will not return values above
+    Upper bound to the cdf table.  Rank will not return values above
     upper
-xtol : float
-    Precision of the brentq solver.
 """
 
 
@@ -236,13 +233,29 @@ class rv_discrete_meco(rv_discrete):
         b = kwargs.get('b', 1e5)
         size = kwargs.get('size', 1)
 
-        model_cdf = self.cdf(np.arange(l, b + 1), *args)
+        # The cdf table is found once per set of scalar shapes and bounds
+        make_cdf = lambda: self.cdf(np.arange(l, b + 1), *args)
+        if all(np.size(arg) == 1 for arg in args):
+            key = ((self.name, 'rvs_alt', l, b) +
+                   tuple(float(arg) for arg in args))
+            model_cdf = _table_cache.get(key, make_cdf)
+        else:
+            model_cdf = make_cdf()
 
+        # Draws above the cdf at b are set to b
         unif_rands = np.random.random(size)
-        model_rands = np.array([np.where(tx <= model_cdf)[0][0] + l
-                            for tx in unif_rands])
+        model_rands = np.searchsorted(model_cdf, unif_rands) + l
+
+        return np.minimum(model_rands, l + len(model_cdf) - 1)
+
+    def _ppf(self, q, *args):
+        # All quantiles for a set of shapes are found from one cdf table
+        return _by_shapes(lambda tq, *shapes: _table_ppf(self, tq, *shapes),
+                          q, *args)
 
-        return model_rands
+    def _support_bounds(self, *args):
+        # Lowest and highest values of the support for scalar shapes
+        return self.a, self.b
 
 
 #
@@ -443,6 +456,9 @@ class geom_uptrunc_gen(rv_discrete_meco):
             cdf = 1
         return cdf
 
+    def _support_bounds(self, p, b):
+        return 0, b
+
     def _stats(self, p, b):
         mu = (p / (1 - p)) - ((b + 1) / (p**-b - 1))
         return mu, None, None, None
@@ -559,37 +575,24 @@ class dgamma_gen(rv_discrete_meco):
 
     def _pmf(self, x, alpha, theta):
 
-        b = 1e5
-        alpha = np.atleast_1d(alpha)
-        theta = np.atleast_1d(theta)
-        b = np.atleast_1d(b)
         x = np.atleast_1d(x)
 
-        eq = lambda val, talpha, ttheta: np.exp((talpha - 1) * np.log(val) -
-            (val / ttheta))
+        # Normalizing constants are summed over 1e5 values once per shapes
+        norm = _by_shapes(lambda tx, talpha, ttheta: _table_cache.get(
+            (self.name, 'norm', talpha, ttheta),
+            lambda: np.sum(_dgamma_eq(np.arange(1, 1e5 + 1), talpha,
+                                      ttheta))), x, alpha, theta)
 
-        # eq = lambda val, talpha, ttheta: val**(talpha - 1) * \
-        #                                 np.exp((-1 / ttheta)*val)
-
-        norm = np.sum(eq(np.arange(1, b[0] + 1), alpha[0], theta[0]))
-
-        pmf = eq(x, alpha, theta) / norm
+        pmf = _dgamma_eq(x, alpha, theta) / norm
         return pmf
 
     def _cdf(self, x, alpha, theta):
 
-        alpha = np.atleast_1d(alpha)
-        theta = np.atleast_1d(theta)
-        x = np.atleast_1d(x)
-
-        max_x = np.max(x)
-        pmf_list = self.pmf(np.arange(1, np.int(max_x) + 1), alpha[0],
-                        theta[0])
-        full_cdf = np.cumsum(pmf_list)
-
-        cdf = np.array([full_cdf[tx - 1] if tx != 0 else 0 for tx in x])
+        return _by_shapes(lambda tx, talpha, ttheta: _table_cdf(
+            self, tx, np.inf, talpha, ttheta), x, alpha, theta)
 
-        return cdf
+    def _support_bounds(self, alpha, theta):
+        return 1, np.inf
 
     def _argcheck(self, alpha, theta):
 
@@ -600,7 +603,9 @@ class dgamma_gen(rv_discrete_meco):
         # Fixed upper limit
         upper = 10000
         vals = np.arange(1, upper)
-        pmf_vals = self.pmf(vals, alpha, theta)
+        pmf_vals = _pmf_table(self, upper - 1, np.inf,
+                              np.atleast_1d(alpha)[0],
+                              np.atleast_1d(theta)[0])[0][:upper - 1]
         mom1 = np.sum(vals * pmf_vals)
         mom2 = np.sum(vals**2 * pmf_vals)
         var_est = mom2 - mom1**2
@@ -609,6 +614,14 @@ class dgamma_gen(rv_discrete_meco):
 dgamma = dgamma_gen(name='dgamma', shapes='alpha, theta')
 
 
+def _dgamma_eq(val, alpha, theta):
+    """
+    Unnormalized pmf of the discrete gamma
+    """
+    return np.exp((alpha - 1) * np.log(val) - (val / theta))
+    # return val**(alpha - 1) * np.exp((-1 / theta)*val)
+
+
 class nbinom_gen(rv_discrete_meco):
     r"""
     A negative binomial discrete random variable.
@@ -630,7 +643,7 @@ class nbinom_gen(rv_discrete_meco):
     -------
     translate_args(mu, k_agg)
         not used, returns mu and k_agg.
-    fit_mle(data, k_range=(0.1,100,0.1))
+    fit_mle(data, k_array=None)
         ml estimate of shape parameters mu and k_agg given data
     %(before_notes)s
     mu : float
@@ -680,17 +693,20 @@ class nbinom_gen(rv_discrete_meco):
         return mu, k_agg
 
     @inherit_docstring_from(rv_discrete_meco)
-    def fit_mle(self, data, k_array=np.arange(0.1, 100, 0.1)):
+    def fit_mle(self, data, k_array=None):
         """%(super)s
 
         In addition to data, gives an optional keyword argument k_array
-        containing the values to search for k_agg. A brute force search is then
-        used to find the parameter k_agg.
+        containing the values to search for k_agg. If k_array is given, a brute
+        force search is used to find the parameter k_agg. Otherwise k_agg is
+        found as the root of the score of the profile likelihood.
 
         """
         # todo: check and mention in docstring biases of mle for k_agg
         data = np.array(data)
         mu = np.mean(data)
+        if k_array is None:
+            return mu, _solve_k_from_score(data, _nbinom_score, mu)
         return mu, _solve_k_from_mu(data, k_array, nbinom_nll, mu)
 
     def _get_p_from_mu(self, mu, k_agg):
@@ -744,6 +760,14 @@ def nbinom_nll(data, k_agg, mu):
     return -np.sum(nbinom._logpmf(data, mu, k_agg))
 
 
+def _nbinom_score(data, k_agg, mu):
+    # Derivative of the nbinom log likelihood with respect to k_agg, with mu
+    # at the mean of data
+    psi = special.psi
+    return (np.sum(psi(k_agg + data) - psi(k_agg)) -
+            len(data) * np.log1p(mu / k_agg))
+
+
 class nbinom_ztrunc_gen(rv_discrete_meco):
     r"""
     The zero-truncated negative binomial random variable.
@@ -913,7 +937,7 @@ class cnbinom_gen(rv_discrete_meco):
     -------
     translate_args(mu, k_agg, b)
         not used, returns mu, k_agg, and b.
-    fit_mle(data, k_array=np.arange(0.1,100,0.1))
+    fit_mle(data, b=sum(data), k_array=None)
         ml estimate of shape parameters mu and k_agg given data
     %(before_notes)s
     mu : float
@@ -959,10 +983,13 @@ class cnbinom_gen(rv_discrete_meco):
 
     >>> # Get and fit random sample
     >>> samp = md.cnbinom.rvs(mu=10, k_agg=1, b=300, size=100)
-    >>> md.cnbinom.fit_mle(samp)
+    >>> mu, k_agg, b = md.cnbinom.fit_mle(samp)
+
+    >>> # Search a grid of k_agg values instead
+    >>> md.cnbinom.fit_mle(samp, k_array=np.arange(0.1, 100, 0.1))
     (11.640000000000001, 1.2000000000000002, 1164)
 
-    >>> # Be more specific about fit_mle
+    >>> # Be more specific about the grid
     >>> md.cnbinom.fit_mle(samp, k_array=np.linspace(1, 1.5, num=1000))
     (11.640000000000001, 1.1966966966966968, 1164)
 
@@ -981,7 +1008,7 @@ class cnbinom_gen(rv_discrete_meco):
         return mu, k_agg, b
 
     @inherit_docstring_from(rv_discrete_meco)
-    def fit_mle(self, data, b=None, k_array=np.arange(0.1, 100, 0.1)):
+    def fit_mle(self, data, b=None, k_array=None):
 
         data = np.array(data)
         mu = np.mean(data)
@@ -989,6 +1016,8 @@ class cnbinom_gen(rv_discrete_meco):
         if not b:
             b = np.sum(data)
 
+        if k_array is None:
+            return mu, _solve_k_from_score(data, _cnbinom_score, mu, b), b
         return mu, _solve_k_from_mu(data, k_array, _cnbinom_nll, mu, b), b
 
     def _pmf(self, x, mu, k_agg, b):
@@ -1000,6 +1029,9 @@ class cnbinom_gen(rv_discrete_meco):
         logpmf[x > b] = -np.inf
         return logpmf
 
+    def _support_bounds(self, mu, k_agg, b):
+        return 0, b
+
     def _stats(self, mu, k_agg, b):
         mu = mu
         var = ((1 - mu / b) * mu * (k_agg + mu)) / (k_agg + (mu / b))
@@ -1020,6 +1052,17 @@ def _cnbinom_nll(data, k_agg, mu, b):
     return -np.sum(cnbinom._logpmf(data, mu, k_agg, b))
 
 
+def _cnbinom_score(data, k_agg, mu, b):
+    # Derivative of the cnbinom log likelihood with respect to k_agg, with mu
+    # at the mean of data
+    psi = special.psi
+    a = mu / b
+    c = 1 / a - 1
+    return (np.sum(psi(k_agg + data) - psi(k_agg) +
+                   c * (psi(b - data + k_agg * c) - psi(k_agg * c))) -
+            len(data) / a * (psi(b + k_agg / a) - psi(k_agg / a)))
+
+
 def _ln_choose(n, k_agg):
     '''
     log binomial coefficient with extended gamma factorials. n and k_agg may be
@@ -1060,6 +1103,70 @@ def _solve_k_from_mu(data, k_array, nll, *args):
 
     return k_array[min_nll_idx]
 
+
+def _solve_k_from_score(data, score, *args, **kwargs):
+    """
+    For given args, return k_agg as the root of the score of the profile
+    likelihood.
+
+    Parameters
+    ----------
+    data : array
+    score : function
+        Derivative of the log likelihood with respect to k_agg, called as
+        score(data, k_agg, *args)
+    args :
+    k_min, k_max : float
+        Bounds on k_agg. Default 1e-8 and 1e8.
+
+    Returns
+    --------
+    :float
+        Maximum likelihood k_agg
+
+    Notes
+    -----
+    The root is bracketed by doubling or halving k_agg from 1, then refined
+    with Brent's method. If the score does not change sign within the bounds,
+    as for data with variance below the mean, the bound in the direction of
+    increasing likelihood is returned. k_max is also returned once the score
+    falls below len(data) * eps * k_agg while k_agg is doubled, as its sign is
+    then rounding noise.
+
+    """
+
+    k_min = kwargs.get('k_min', 1e-8)
+    k_max = kwargs.get('k_max', 1e8)
+    f = lambda k: score(data, k, *args)
+
+    k_lo = k_hi = 1.0
+    f_start = f(k_lo)
+    if f_start == 0:
+        return k_lo
+
+    # Likelihood increases with k_agg if the score is positive. At large
+    # k_agg the digamma differences in the score cancel, and once the score
+    # is below the rounding noise of its terms the likelihood is taken as
+    # flat up to k_max.
+    noise = len(data) * np.finfo(float).eps
+    if f_start > 0:
+        while True:
+            f_hi = f(k_hi)
+            if abs(f_hi) < noise * k_hi:
+                return k_max
+            if f_hi <= 0:
+                break
+            k_lo, k_hi = k_hi, 2 * k_hi
+            if k_hi > k_max:
+                return k_max
+    else:
+        while f(k_lo) < 0:
+            k_lo, k_hi = k_lo / 2, k_lo
+            if k_lo < k_min:
+                return k_min
+
+    return optim.brentq(f, k_lo, k_hi, rtol=1e-12)
+
 class logser_gen(rv_discrete_meco):
     """
     Logseries (logarithmic) random variable.
@@ -1254,53 +1361,44 @@ b : float
         p = np.atleast_1d(p)
         b = np.atleast_1d(b)
 
-        if p[0] > 0:
-            pmf = stats.logser.pmf(x, p) / stats.logser.cdf(b, p)
-        else:
-            ivals = np.arange(1, b[0] + 1)
-            normalization = np.sum(p[0] ** ivals / ivals)
-            pmf = (p[0] ** x / x) / normalization
+        # Normalizing constants are found once per shapes
+        normalization = _by_shapes(lambda tx, tp, tb: _table_cache.get(
+            (self.name, 'norm', tp, tb),
+            lambda: _logser_uptrunc_norm(tp, tb)), x, p, b)
+
+        # Terms of the sum truncated at b, which is finite for any p
+        pmf = (p[0] ** x / x) / normalization
+        pmf[x < 1] = 0
 
         return pmf
 
     def _cdf(self, x, p, b):
 
-        x = np.atleast_1d(x)
-        p = np.atleast_1d(p)
-        b = np.atleast_1d(b)
+        # Sums of the pmf up to b, found once per shapes
+        return _by_shapes(lambda tx, tp, tb: _table_cdf(self, tx, tb, tp, tb),
+                          x, p, b)
 
-        if p[0] < 1:
-            return stats.logser.cdf(x, p) / stats.logser.cdf(b, p)
-        else:
-            cdf_list = [sum(self.pmf(range(1, int(x_i) + 1), p[0], b[0])) for
-                                                x_i in x]
-            return np.array(cdf_list)
+    def _support_bounds(self, p, b):
+        return 1, b
 
     def _rvs(self, p, b):
-        # Code from weecology/macroecotools
 
         if not self._size:
             self._size = 1
 
-        out = []
-        if p < 1:
-            for i in range(self._size):
-                rand_logser = stats.logser.rvs(p)
-                while rand_logser > b:
-                    rand_logser = stats.logser.rvs(p)
-                out.append(rand_logser)
-        else:
-            rand_list = stats.uniform.rvs(size = self._size)
-            for rand_num in rand_list:
-                y = lambda x: self.cdf(x, p, b) - rand_num
-                if y(1) > 0: out.append(1)
-                else: out.append(int(round(bisect(y, 1, b))))
-        return np.array(out)
+        # Inverse cdf of uniform draws, from one cdf table up to at most b
+        p = float(np.atleast_1d(p)[0])
+        b = float(np.atleast_1d(b)[0])
+        rands = _table_ppf(self, nprand.random(self._size), p, b)
+
+        return rands.astype(int)
 
     def _stats(self, p, b):
 
+        p = np.atleast_1d(p)[0]
+        b = np.atleast_1d(b)[0]
         vals = np.arange(1, b + 1)
-        full_pmf = self.pmf(vals, p, b)
+        full_pmf = _pmf_table(self, b, b, p, b)[0][:len(vals)]
         mean, var = _mean_var(vals, full_pmf)
         return mean, var, None, None
 
@@ -1308,6 +1406,15 @@ b : float
 logser_uptrunc = logser_uptrunc_gen(name="logser_uptrunc", shapes="p, b")
 
 
+def _logser_uptrunc_norm(p, b):
+    """
+    Normalizing constant of the pmf of the upper truncated logseries
+    """
+
+    ivals = np.arange(1, b + 1)
+    return np.sum(p ** ivals / ivals)
+
+
 def _trunc_logser_solver(bins, b):
     """
     Given bins (S) and b (N) solve for MLE of truncated logseries
@@ -1365,6 +1472,10 @@ class plnorm_gen(rv_discrete_meco):
     The pmf method was adopted directly from the VGAM package in R.
     The VGAM R package was adopted directly from Bulmer (1974) [#]_
 
+    For values up to 10, the pmf is found by quadrature of its integral, for
+    all values and shape parameters at once (see _plnorm_pmf_quad). Above 10,
+    Bulmer's approximation is used.
+
     The fit_mle function was adapted from Ethan White's pln_solver function in
     macroeco_distributions (https://github.com/weecology/macroecotools)
 
@@ -1392,8 +1503,8 @@ class plnorm_gen(rv_discrete_meco):
     array([ 0.3954088 ,  0.90489995,  0.99999662])
 
     >>> # Rank abundance distribution
-    >>> md.plnorm.rank(10, 1, 1, crit=0.5, upper=40)
-    array([  0.,   0.,   1.,   2.,   2.,   4.,   5.,   7.,   8.,  15.])
+    >>> md.plnorm.rank(10, 1, 1, upper=40)
+    array([  0.,   0.,   1.,   2.,   2.,   3.,   4.,   6.,   8.,  15.])
 
     >>> # Fit the the plnorm to data
     >>> data = np.array([1,1,1,1,1,2,2,2,3,3,4,4,5,5,6,6,12,45,67])
@@ -1427,7 +1538,7 @@ class plnorm_gen(rv_discrete_meco):
 
     @inherit_docstring_from(rv_discrete_meco)
     @doc_sub(_doc_make_rank)
-    def rank(self, n, mu, sigma, crit=.5, upper=10000, xtol=1):
+    def rank(self, n, mu, sigma, upper=10000):
         """%(super)s
 
 Additional Parameters
@@ -1436,8 +1547,7 @@ Additional Parameters
 
         """
 
-        return _make_rank(self, n, mu, sigma, crit=crit, upper=upper,
-                                                                    xtol=xtol)
+        return _make_rank(self, n, mu, sigma, upper=upper)
 
     def _argcheck(self, mu, sigma):
         return True
@@ -1451,11 +1561,11 @@ Additional Parameters
         xbelow = x <= approx_cut
         xabove = x > approx_cut
 
-        # If below, use exact answer
+        # If below, use exact answer, once for each distinct x
         if np.sum(xbelow) > 0:
 
-            pmf[xbelow] = plognorm_intg_vec(x[xbelow], mu[xbelow],
-                                                                sigma[xbelow])
+            pmf[xbelow] = _by_shapes(_plnorm_pmf_quad_unique, x[xbelow],
+                                     mu[xbelow], sigma[xbelow])
 
         # If above, use approximation
         if np.sum(xabove) > 0:
@@ -1541,11 +1651,10 @@ class plnorm_ztrunc_gen(rv_discrete_meco):
     >>> md.plnorm_ztrunc.cdf([1, 15, 10000], mu=.1, sigma=2)
     array([ 0.27575055,  0.84270355,  0.99999442])
 
-    >>> # Rank abundance distribution. For speed, set crit = 0 or else the
-    >>> # calculation is very slow.
-    >>> md.plnorm_ztrunc.rank(20, 1, 1, crit=0, upper=40)
-    array([  1.,   1.,   2.,   2.,   2.,   2.,   2.,   3.,   3.,   4.,   5.,
-         5.,   6.,   6.,   7.,   7.,   8.,  11.,  14.,  22.])
+    >>> # Rank abundance distribution
+    >>> md.plnorm_ztrunc.rank(20, 1, 1, upper=40)
+    array([  1.,   1.,   1.,   1.,   2.,   2.,   2.,   2.,   3.,   3.,   4.,
+         4.,   5.,   5.,   6.,   7.,   8.,  10.,  13.,  22.])
 
     >>> # Fit the the plnorm to data
     >>> data = np.array([1,1,1,1,1,2,2,2,3,3,4,4,5,5,6,6,12,45,67])
@@ -1580,7 +1689,7 @@ class plnorm_ztrunc_gen(rv_discrete_meco):
 
     @inherit_docstring_from(rv_discrete_meco)
     @doc_sub(_doc_make_rank)
-    def rank(self, n, mu, sigma, crit=0, upper=10000, xtol=1):
+    def rank(self, n, mu, sigma, upper=10000):
         """%(super)s
 
 Additional Parameters
@@ -1589,8 +1698,7 @@ Additional Parameters
 
         """
 
-        return _make_rank(self, n, mu, sigma, crit=crit, upper=upper,
-                                                                    xtol=xtol)
+        return _make_rank(self, n, mu, sigma, upper=upper)
     def _argcheck(self, mu, sigma):
         return True
 
@@ -1600,7 +1708,7 @@ Additional Parameters
         mu = np.atleast_1d(mu)
         sigma = np.atleast_1d(sigma)
 
-        norm = 1 - plognorm_intg_vec(0, mu[0], sigma[0])
+        norm = 1 - _plnorm_pmf_quad(0, mu[0], sigma[0])
         pmf_vals = plnorm.pmf(x, mu, sigma) / norm
         pmf_vals[x < 1] = 0
 
@@ -1614,7 +1722,7 @@ Additional Parameters
         sigma = np.atleast_1d(sigma)
 
         # Calculate cdf from plnorm_gen
-        norm = 1 - plognorm_intg_vec(0, mu[0], sigma[0])
+        norm = 1 - _plnorm_pmf_quad(0, mu[0], sigma[0])
         cdf_vals = (plnorm.cdf(x, mu, sigma) -
                                         plnorm.cdf(0, mu[0], sigma[0])) / norm
 
@@ -1642,6 +1750,120 @@ def plognorm_intg(x, mu, sigma):
 
 plognorm_intg_vec = np.vectorize(plognorm_intg)
 
+# Most trapezoid nodes for each value in _plnorm_pmf_quad
+_PLNORM_MAX_NODES = 2**14
+
+
+def _plnorm_pmf_quad(x, mu, sigma):
+    """
+    Poisson lognormal pmf by trapezoidal quadrature in log space
+
+    Parameters
+    ----------
+    x : array_like
+        Values
+    mu, sigma : array_like
+        Shape parameters, broadcast against x
+
+    Returns
+    -------
+    array
+        Pmf at x, within a relative 1e-12 of the integral found by quad with
+        a relative tolerance of 1e-13
+
+    Notes
+    -----
+    The pmf is the integral over t of exp(g(t)) / (sqrt(2 pi) sigma x!),
+    where g(t) = x t - exp(t) - (t - mu)**2 / (2 sigma**2) is concave. Newton
+    iterations, vectorized over all values, find the mode of g and the points
+    either side of it where g has fallen by 40. The integral is a trapezoid
+    sum over evenly spaced nodes between these points, taken relative to the
+    mode. The spacing is set by the curvature of g at the upper point, the
+    largest between the points. Trapezoid sums of smooth integrands that
+    vanish at both ends converge geometrically, so that all values share a
+    modest number of nodes and are found in one broadcast expression. Any
+    value that would need more than 2**14 nodes falls back to quad.
+
+    Gauss-Hermite nodes, scaled either to the lognormal or to the curvature at
+    the mode, are too coarse for the narrow peak of the integrand at large x
+    or for its wide lower tail at large sigma, respectively.
+
+    """
+
+    x, mu, sigma = np.broadcast_arrays(*[np.asarray(y, dtype=float)
+                                         for y in (x, mu, sigma)])
+    if not x.size:
+        return np.zeros(x.shape)
+    inv_var = 1 / sigma**2
+
+    g = lambda t: _plnorm_log_intg(t, x, mu, inv_var)
+    dg = lambda t: x - np.exp(t) - (t - mu) * inv_var
+
+    # Started above the mode, so that exp(t) only falls
+    mode = _newton_concave(dg, lambda t: -np.exp(t) - inv_var,
+                           np.maximum(mu, np.log(x + 1)))
+    g_mode = g(mode)
+
+    # Curvature of g is at least that at the mode above it and at least
+    # inv_var below it, so that these starts are outside the points. Above
+    # the mode, g also falls faster than exp(t) - exp(mode) (1 + t - mode),
+    # which bounds the upper start when the lognormal is wide.
+    drop = lambda t: g(t) - g_mode + 40
+    width = 1 / np.sqrt(np.exp(mode) + inv_var)
+    upper = _newton_concave(drop, dg,
+                            np.minimum(mode + np.sqrt(80) * width,
+                                       np.maximum(mode, 0) + np.log(80) + 1))
+    lower = _newton_concave(drop, dg, mode - np.sqrt(80) * sigma)
+
+    # Values that would need too many nodes are left to quad
+    spans = (upper - lower) * np.sqrt(np.exp(upper) + inv_var) / 0.8
+    use_quad = ~(spans <= _PLNORM_MAX_NODES)
+    n_nodes = (int(np.ceil(np.max(spans[~use_quad]))) + 1
+               if np.any(~use_quad) else 2)
+    step = (upper - lower) / (n_nodes - 1)
+
+    nodes = (lower[..., np.newaxis] +
+             step[..., np.newaxis] * np.arange(n_nodes))
+    terms = np.exp(_plnorm_log_intg(nodes, x[..., np.newaxis],
+                                    mu[..., np.newaxis],
+                                    inv_var[..., np.newaxis]) -
+                   g_mode[..., np.newaxis])
+
+    log_pmf = (g_mode + np.log(step * np.sum(terms, axis=-1)) -
+               0.5 * np.log(2 * np.pi * sigma**2) - special.gammaln(x + 1))
+    pmf = np.array(np.exp(log_pmf))
+    if np.any(use_quad):
+        pmf[use_quad] = plognorm_intg_vec(x[use_quad], mu[use_quad],
+                                          sigma[use_quad])
+    return pmf
+
+
+def _plnorm_pmf_quad_unique(x, mu, sigma):
+    # Pmf for scalar shapes, found once for each distinct x
+    unique_x, inverse = np.unique(x, return_inverse=True)
+    return _plnorm_pmf_quad(unique_x, mu, sigma)[inverse]
+
+
+def _plnorm_log_intg(t, x, mu, inv_var):
+    # Log of the integrand of the Poisson lognormal pmf, without constants
+    return x * t - np.exp(t) - 0.5 * (t - mu)**2 * inv_var
+
+
+def _newton_concave(func, fprime, t, tol=1e-10, maxiter=200):
+    """
+    Vectorized Newton iterations for the roots of monotone concave functions
+
+    Started on the side of each root where the function is negative, the
+    iterations approach it from that side without overshooting.
+    """
+
+    for _ in range(maxiter):
+        step = func(t) / fprime(t)
+        t = t - step
+        if not np.any(np.abs(step) >= tol):
+            break
+    return t
+
 
 
 #
@@ -1973,11 +2195,9 @@ lognorm = lognorm_gen(name="lognorm", shapes="mu, sigma")
 
 
 @doc_sub(_doc_make_rank)
-def _make_rank(dist_obj, n, mu, sigma, crit=0.5, upper=10000, xtol=1):
+def _make_rank(dist_obj, n, mu, sigma, upper=10000):
     """
-    Make rank distribution using both ppf and brute force.
-
-    Setting crit = 1 is equivalent to just using the ppf
+    Make rank distribution from a cdf table reaching at most upper
 
     Parameters
     ----------
@@ -1985,31 +2205,17 @@ def _make_rank(dist_obj, n, mu, sigma, crit=0.5, upper=10000, xtol=1):
 
     """
     qs = (np.arange(1, n + 1) - 0.5) / n
-    rank = np.empty(len(qs))
-
-    brute_ppf = lambda val, prob: prob - dist_obj.cdf(val, mu, sigma)
-
-    qs_less = qs <= crit
-    ind = np.sum(qs_less)
-
-    # Use ppf if qs are below crit
-    rank[qs_less] = dist_obj.ppf(qs[qs_less], mu, sigma)
+    lower = int(dist_obj._support_bounds(mu, sigma)[0])
+    n_max = upper - lower + 1
+    cdf = _support_cdf(dist_obj, qs[-1], n_max, mu, sigma)[1][:n_max]
 
-    # Use brute force if they are above
-    for i, tq in enumerate(qs[~qs_less]):
+    idx = np.searchsorted(cdf, qs)
+    rank = lower + idx.astype(float)
 
-        j = ind + i
-        try:
-            # TODO: Use an adaptable lower bound to increase speed
-            rank[j] = np.abs(np.ceil(optim.brentq(brute_ppf, -1, upper,
-                                        args=(tq,), xtol=xtol)))
-
-        except ValueError:
-
-            # If it is above the upper bound set all remaining values
-            # to the previous value
-            rank[j:] = np.repeat(rank[j - 1], len(rank[j:]))
-            break
+    # If quantiles are above the upper bound set them to the previous value
+    above = idx == len(cdf)
+    if np.any(above):
+        rank[above] = rank[~above][-1] if np.any(~above) else upper
 
     return rank
 
@@ -2037,3 +2243,217 @@ def _mean_var(vals, pmf):
     return mean, var
 
 
+class _TableCache(object):
+    """
+    Least recently used cache of normalizing constants and pmf tables
+
+    Parameters
+    ----------
+    max_size : int
+        Largest total number of values held in the cache. Default 2**22, or
+        32 MB of floats.
+    max_entries : int
+        Largest number of entries held in the cache. Default 1024.
+
+    Notes
+    -----
+    Entries are keyed by distribution name, kind of entry, and shape
+    parameters. When adding an entry takes the total number of values above
+    max_size, or the number of entries above max_entries, the least recently
+    used entries are evicted. Entries larger than max_size are returned
+    without being cached.
+
+    """
+
+    def __init__(self, max_size=2**22, max_entries=1024):
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, key, make):
+        """
+        Value cached for key, calling make() to find it if it is not cached
+        """
+
+        value = self._lookup(key)
+        if value is None:
+            value = self._add(key, make())
+        return value
+
+    def pmf_table(self, key, n, b, make_pmf):
+        """
+        Pmf and cdf tables with at least n values, or all values up to b
+
+        make_pmf(m) gives the pmf of the first m values of the support. A
+        cached table that is too short is replaced by one at least twice as
+        long, so that tables grow in few steps.
+        """
+
+        tables = self._lookup(key)
+        have = -1 if tables is None else len(tables[0])
+        if have < min(n, b):
+            m = int(min(max(n, 2 * have), b))
+            pmf = np.asarray(make_pmf(m), dtype=float)
+            tables = self._add(key, (pmf, np.cumsum(pmf)))
+        return tables
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    def _lookup(self, key):
+        # Cached value, now most recently used, or None
+        if key not in self._entries:
+            return None
+        entry = self._entries.pop(key)
+        self._entries[key] = entry
+        return entry[0]
+
+    def _add(self, key, value):
+
+        if isinstance(value, tuple):
+            size = sum(np.size(x) for x in value)
+        else:
+            size = np.size(value)
+
+        if key in self._entries:
+            self._size -= self._entries.pop(key)[1]
+        if size > self.max_size:
+            return value
+
+        while self._entries and (self._size + size > self.max_size or
+                                 len(self._entries) >= self.max_entries):
+            _, (_, old_size) = self._entries.popitem(last=False)
+            self._size -= old_size
+
+        self._entries[key] = (value, size)
+        self._size += size
+        return value
+
+_table_cache = _TableCache()
+
+
+def _by_shapes(func, x, *shapes):
+    """
+    Apply func(x, *shapes) to the values of x for each distinct set of shapes
+
+    Parameters
+    ----------
+    func : function
+        Called with an array of values and scalar shape parameters, returning
+        an array of results for the values
+    x : array_like
+        Values
+    shapes : array_like
+        Shape parameters, broadcast against x
+
+    Returns
+    -------
+    array
+        Results for all values, in the shape of x broadcast against shapes
+
+    Notes
+    -----
+    scipy broadcasts shape parameters to the shape of x, so that they are
+    nearly always all the same. func is then called once.
+
+    """
+
+    arrays = np.broadcast_arrays(np.atleast_1d(x),
+                                 *[np.atleast_1d(y) for y in shapes])
+    x = arrays[0].ravel()
+    flat_shapes = [y.ravel() for y in arrays[1:]]
+    result = np.zeros(len(x))
+    if not len(x):
+        return result.reshape(arrays[0].shape)
+
+    if all(np.all(y == y[0]) for y in flat_shapes):
+        groups = [(tuple(y[0] for y in flat_shapes), slice(None))]
+    else:
+        rows = OrderedDict()
+        for i, row in enumerate(zip(*flat_shapes)):
+            rows.setdefault(row, []).append(i)
+        groups = rows.items()
+
+    for row, idx in groups:
+        result[idx] = func(x[idx], *[float(y) for y in row])
+
+    return result.reshape(arrays[0].shape)
+
+
+def _pmf_table(dist_obj, n, b, *shapes):
+    """
+    Cached pmf and cdf tables of dist_obj with support starting at 1, of at
+    least n values or of all values up to b
+    """
+    key = (dist_obj.name, 'pmf') + shapes
+    return _table_cache.pmf_table(key, n, b, lambda m: dist_obj._pmf(
+        np.arange(1, m + 1), *shapes))
+
+
+def _support_cdf(dist_obj, q, n_max, *shapes):
+    """
+    Cached pmf and cdf tables of dist_obj from the lowest value of its
+    support, extended until the cdf reaches q or the tables hold n_max values
+
+    Tables are doubled in length until they are long enough, and stop growing
+    early if a doubling does not increase the cdf.
+    """
+
+    lower = int(dist_obj._support_bounds(*shapes)[0])
+    key = (dist_obj.name, 'support') + shapes
+    make_pmf = lambda m: dist_obj.pmf(np.arange(lower, lower + m), *shapes)
+
+    n = min(64, n_max)
+    last = -np.inf
+    while True:
+        tables = _table_cache.pmf_table(key, n, n_max, make_pmf)
+        cdf = tables[1]
+        if cdf[-1] >= q or len(cdf) >= n_max or not cdf[-1] > last:
+            return tables
+        last = cdf[-1]
+        n = 2 * len(cdf)
+
+
+def _table_ppf(dist_obj, q, *shapes):
+    """
+    Ppf of dist_obj at q from its cached cdf table, using the generic search
+    of rv_discrete for quantiles beyond the largest table that is built
+    """
+
+    q = np.atleast_1d(q)
+    lower, upper = dist_obj._support_bounds(*shapes)
+    n_max = min(upper - lower + 1, _table_cache.max_size // 2)
+    cdf = _support_cdf(dist_obj, np.max(q), int(n_max), *shapes)[1]
+
+    idx = np.searchsorted(cdf, q)
+    ppf = lower + idx.astype(float)
+
+    beyond = idx == len(cdf)
+    if np.any(beyond):
+        if len(cdf) == upper - lower + 1:
+            # Rounding left the cdf at the end of the support just below q
+            ppf[beyond] = upper
+        else:
+            ppf[beyond] = rv_discrete._ppf(dist_obj, q[beyond], *shapes)
+
+    return ppf
+
+
+def _table_cdf(dist_obj, x, b, *shapes):
+    """
+    Cdf of dist_obj at x from its cached cdf table, with support starting at
+    1 and ending at b
+    """
+
+    x = np.floor(np.atleast_1d(x))
+    n = int(min(max(np.max(x), 1), b))
+    cdf_table = _pmf_table(dist_obj, n, b, *shapes)[1]
+
+    # Values beyond the table are at or above b, with cdf of 1
+    cdf = np.ones(len(x))
+    inside = x <= len(cdf_table)
+    cdf[inside] = cdf_table[np.maximum(x[inside].astype(int), 1) - 1]
+    cdf[x < 1] = 0
+    return cdf
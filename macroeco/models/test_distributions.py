@@ -7,9 +7,13 @@ from numpy.testing import (TestCase, assert_equal, assert_array_equal,
 import numpy as np
 from decimal import Decimal
 from macroeco.models import *
-from macroeco.models._distributions import _trunc_logser_solver
+from macroeco.models._distributions import (_trunc_logser_solver,
+                                            _TableCache, _plnorm_pmf_quad)
 import matplotlib.pyplot as plt
 import scipy as sp
+import scipy.integrate
+import scipy.optimize
+import scipy.special
 import scipy.stats as stats
 
 
@@ -38,6 +42,16 @@ class TestGeom(TestCase):
         p = geom.fit_mle([1,2,4,5])
         assert_almost_equal(p, 0.25)
 
+    def test_ppf(self):
+        # Smallest k with 1 - (1-p)^(k+1) >= q
+        qs = (np.arange(1, 101) - 0.5) / 100
+        expected = np.ceil(np.log(1 - qs) / np.log(1 - 0.1)) - 1
+        assert_array_equal(geom.ppf(qs, 0.1), expected)
+
+    def test_ppf_mixed_shapes(self):
+        vals = geom.ppf([0.6, 0.6, 0.6], [0.1, 0.5, 0.1])
+        assert_array_equal(vals, [8, 1, 8])
+
 
 class TestGeomUptrunc(TestCase):
 
@@ -103,6 +117,14 @@ class TestGeomUptrunc(TestCase):
         p2, _ = geom_uptrunc.fit_mle([1,3], 16)
         assert_almost_equal(p2, 1-0.669, decimal=2)
 
+    def test_ppf_stops_at_b(self):
+        # Nearly flat pmf, so the cdf must be tabled up to b and no further
+        vals = geom_uptrunc.ppf([0.05, 0.5, 0.999999], 0.001, 20)
+        assert_array_equal(vals, [1, 10, 20])
+
+        rad = geom_uptrunc.rank(1000, 0.001, 20)
+        assert_equal(rad.max(), 20)
+
 
 class TestNbinom(TestCase):
 
@@ -143,6 +165,21 @@ class TestNbinom(TestCase):
         mu, k = nbinom.fit_mle(x, k_array=np.arange(0.01,10,0.01))
         assert_array_almost_equal([mu, k], [9, 8.54], decimal=2)
 
+    def test_fit_mle_root_matches_grid(self):
+        # Root of the score is the continuous version of the grid search
+        x = np.array([6,17,14,12,8,10,4,9,3,12,4,2,12,8,14,16,9,10,8,5,6])
+        mu, k = nbinom.fit_mle(x)
+        assert_almost_equal(k, 8.540990, decimal=5)
+
+        x = np.array(range(1,50))
+        mu, k = nbinom.fit_mle(x)
+        assert_almost_equal(k, 2.4337345, decimal=6)
+
+    def test_fit_mle_underdispersed(self):
+        # Variance below the mean gives the largest k_agg allowed
+        mu, k = nbinom.fit_mle([4, 5, 5, 6])
+        assert_equal(k, 1e8)
+
     def test_alternative_rvs(self):
         rand_alt = nbinom.rvs_alt(5, 1, l=0, size=10000)
         rand = nbinom.rvs(5, 1, size=10000)
@@ -152,6 +189,17 @@ class TestNbinom(TestCase):
 
         assert_almost_equal(alt_k, k, decimal=1)
 
+    def test_alternative_rvs_matches_cdf_search(self):
+        # Each draw is the first value whose cdf is at or above a uniform
+        np.random.seed(3)
+        rand_alt = nbinom.rvs_alt(5, 1, l=0, b=200, size=1000)
+
+        np.random.seed(3)
+        model_cdf = nbinom.cdf(np.arange(0, 201), 5, 1)
+        expected = [np.where(tx <= model_cdf)[0][0]
+                    for tx in np.random.random(1000)]
+        assert_array_equal(rand_alt, expected)
+
 
 class TestNbinom_ztrunc(TestCase):
 
@@ -217,6 +265,18 @@ class TestCnbinom(TestCase):
         k_fit = cnbinom.fit_mle(data)[0]
         assert_equal(False, k_fit == -0.26)
 
+    def test_fit_mle_root_matches_grid(self):
+        x = np.array([6,17,14,12,8,10,4,9,3,12,4,2,12,8,14,16,9,10,8,5,6])
+        k_grid = cnbinom.fit_mle(x, k_array=np.arange(0.01, 20, 0.01))[1]
+        k_root = cnbinom.fit_mle(x)[1]
+        assert_almost_equal(k_root, 7.767244, decimal=5)
+        assert_(np.abs(k_root - k_grid) <= 0.01)
+
+    def test_fit_mle_underdispersed(self):
+        # Variance below the binomial limit gives the largest k_agg allowed
+        mu, k, b = cnbinom.fit_mle([4, 5, 5, 6])
+        assert_equal(k, 1e8)
+
     def test_zillio_plots(self):
         """ Test the cnbinom function replicated the Zillio and He plots
 
@@ -444,6 +504,48 @@ class TestLogserUptrunc(TestCase):
         res2 = lognorm.rvs(.9, 100, size=5)  # Should be length 5
         assert_equal(5, len(res2))
 
+    def test_rvs_within_support(self):
+        np.random.seed(2)
+        for p, b in [(.9, 100), (1.01, 50)]:
+            res = logser_uptrunc.rvs(p, b, size=10000)
+            assert_(res.min() >= 1 and res.max() <= b)
+            assert_almost_equal(res.mean() / logser_uptrunc.mean(p, b), 1,
+                                decimal=1)
+
+
+class TestTableCache(TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = _TableCache(max_size=5)
+        cache.get('a', lambda: np.ones(2))
+        cache.get('b', lambda: np.ones(2))
+        cache.get('a', lambda: np.zeros(2))  # Cached, now most recently used
+        cache.get('c', lambda: np.ones(2))
+        assert_equal(list(cache._entries.keys()), ['a', 'c'])
+        assert_array_equal(cache.get('a', lambda: np.zeros(2)), [1, 1])
+        assert_equal(list(cache._entries.keys()), ['c', 'a'])
+
+        # Too large to cache
+        cache.get('d', lambda: np.ones(10))
+        assert_equal(list(cache._entries.keys()), ['c', 'a'])
+
+    def test_pmf_table_grows(self):
+        cache = _TableCache()
+        pmf, cdf = cache.pmf_table('t', 3, np.inf, lambda m: np.ones(m))
+        assert_array_equal(cdf, [1, 2, 3])
+        pmf, cdf = cache.pmf_table('t', 4, np.inf, lambda m: np.ones(m))
+        assert_equal(len(pmf), 6)
+        pmf, cdf = cache.pmf_table('u', 10, 4, lambda m: np.ones(m))
+        assert_equal(len(pmf), 4)
+
+    def test_cached_cdf_matches_pmf(self):
+        vals = np.arange(0, 50)
+        assert_array_almost_equal(dgamma.cdf(vals, 2, 3),
+                                  np.cumsum(dgamma.pmf(vals, 2, 3)))
+        assert_array_almost_equal(logser_uptrunc.cdf([5, 100, 150], .9, 100),
+                                  [np.sum(logser_uptrunc.pmf(
+                                      np.arange(1, 6), .9, 100)), 1, 1])
+
 
 class TestLognorm(TestCase):
 
@@ -534,6 +636,23 @@ class TestLognorm(TestCase):
         assert_equal(len(res), 4)
 
 
+def _plnorm_pmf_ref(x, mu, sigma):
+    # Poisson lognormal pmf by quad to a relative 1e-13, on an interval
+    # around the mode of the integrand in log space beyond which it is below
+    # exp(-72) of its largest value
+    log_intg = lambda t: t * x - np.exp(t) - 0.5 * ((t - mu) / sigma) ** 2
+    mode = sp.optimize.brentq(
+        lambda t: x - np.exp(t) - (t - mu) / sigma ** 2,
+        min(mu - 2 * sigma ** 2, 0), max(mu, np.log(x + 1)) + 1, xtol=1e-14)
+    lower = mode - 12 * sigma
+    upper = mode + 12 / np.sqrt(np.exp(mode) + 1 / sigma ** 2)
+    intg = sp.integrate.quad(lambda t: np.exp(log_intg(t) - log_intg(mode)),
+                             lower, upper, points=[mode], epsabs=0,
+                             epsrel=1e-13, limit=200)[0]
+    return np.exp(-0.5 * np.log(2 * np.pi * sigma ** 2) -
+                  sp.special.gammaln(x + 1) + log_intg(mode) + np.log(intg))
+
+
 class TestPlnorm(TestCase):
 
     def test_pmf(self):
@@ -587,6 +706,20 @@ class TestPlnorm(TestCase):
             assert_almost_equal(test, float(vals[2]), decimal=4)
 
 
+    def test_pmf_quad_matches_quad(self):
+
+        # Within a relative 1e-12 of quad run to a relative 1e-13
+        x = np.arange(0, 11)
+        for mu, sigma in [(-2, 0.5), (0.1, 2), (2.34, 5), (5, 10), (-5, 1)]:
+            ref = [_plnorm_pmf_ref(tx, mu, sigma) for tx in x]
+            assert_allclose(_plnorm_pmf_quad(x, mu, sigma), ref, rtol=1e-12,
+                            atol=0)
+
+        # Broadcast over values and shapes at once
+        test = _plnorm_pmf_quad([[0], [3]], [-1, 2], [3, 0.5])
+        ref = np.vectorize(_plnorm_pmf_ref)([[0], [3]], [-1, 2], [3, 0.5])
+        assert_allclose(test, ref, rtol=1e-12, atol=0)
+
     def test_cdf(self):
 
         # Test against R VGAM fxn: ppolono(c(0, 15, 10000), .1, 2)
@@ -627,7 +760,7 @@ class TestPlnorm(TestCase):
             4., 4.,   5.,   5.,   5.,   6.,   6.,   6.,   7.,   7.,   8.,   9.,
             10.,  11.,  13.,  15.,  19.,  29.])
 
-        pred_res = plnorm.rank(50, 1, 1, crit=0.5, upper=40)
+        pred_res = plnorm.rank(50, 1, 1, upper=40)
 
         # Test the values are within one
         diff = np.abs(pred_res - test_case)
@@ -671,13 +804,13 @@ class TestPlnormZtrunc(TestCase):
 
     def test_rank(self):
 
-        # TODO: Can't test this against ppf because ppf is too slow
-
-        # Make sure it is working when crit = 0
-        test = [ 1., 1., 2., 2., 2., 2., 2., 3., 3.,
-                4., 5., 5., 6., 6., 7., 7., 8., 11., 14., 22.]
-        rad = plnorm_ztrunc.rank(20, 1, 1, crit=0, upper=40)
+        # Smallest values with cdf at or above (i - 0.5) / 20
+        test = [ 1., 1., 1., 1., 2., 2., 2., 2., 3.,
+                3., 4., 4., 5., 5., 6., 7., 8., 10., 13., 22.]
+        rad = plnorm_ztrunc.rank(20, 1, 1, upper=40)
         assert_array_equal(test, rad)
+        assert_array_equal(plnorm_ztrunc.ppf((np.arange(1, 21) - 0.5) / 20,
+                                             1, 1), rad)
 
 class TestExpon(TestCase):
 
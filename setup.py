@@ -24,8 +24,8 @@ setup(
     ],
 
     install_requires = [
-        'numpy>=1.6',
-        'scipy>=0.12',
+        'numpy>=1.10',
+        'scipy>=0.18',
         'pandas>=0.14',
         'matplotlib>=1.3',
         'mpmath>=0.19',